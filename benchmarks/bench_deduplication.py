@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""Benchmark for the disk deduplication filter.
+
+The synthetic corpus follows the numbers in `skyscraper.deduplication`:
+8.5 million unique IDs with long common prefixes. Use `--scale` to run
+with a fraction of it, e.g. `--scale 0.01` in CI. The corpus only depends
+on the seed, so runs with the same arguments are comparable.
+
+Each configuration runs in its own process, so that the reported peak RSS
+belongs to that configuration only. IDs are inserted as they are
+generated and `peak_rss_bytes` is the growth of the peak RSS after the
+process was set up, so it only measures the filter. Results are printed
+as one JSON object per line.
+
+    PYTHONPATH=. python benchmarks/bench_deduplication.py --scale 0.01
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import itertools
+import resource
+import tempfile
+import multiprocessing
+
+import click
+
+from skyscraper.deduplication import DiskTrieDuplicatesFilter
+
+
+PRODUCTION_IDS = 8500000
+
+NAMESPACES = ['news', 'shop', 'jobs', 'realestate', 'forum']
+PREFIXES = [
+    'https://www.example-newspaper.com/politik/deutschland/',
+    'https://www.example-newspaper.com/wirtschaft/unternehmen/',
+    'https://shop.example.org/products/category/electronics/item/',
+    'https://jobs.example.net/search/results/offer?id=',
+    'https://realestate.example.com/expose/berlin/apartment/',
+    'https://forum.example.de/threads/general-discussion/thread-',
+]
+
+
+def generate_ids(count, seed):
+    """Generate `count` unique IDs like the ones of our spiders:
+    namespace, a long URL prefix and a unique suffix.
+    """
+    rng = random.Random(seed)
+    for i in range(count):
+        namespace = rng.choice(NAMESPACES)
+        prefix = rng.choice(PREFIXES)
+        yield '{}-{}{:x}-{}'.format(
+            namespace, prefix, rng.getrandbits(32), i)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def directory_size(path):
+    total = 0
+    for directory, _, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(directory, filename))
+    return total
+
+
+def time_lookups(duplicates_filter, words):
+    latencies = []
+    for word in words:
+        start = time.perf_counter()
+        duplicates_filter.has_word(word)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def peak_rss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_benchmark(config, num_ids, num_lookups, batch_size, seed):
+    # IDs that are in the filter are drawn by index while inserting, so
+    # that the corpus is never held in memory and does not add to the RSS
+    rng = random.Random(seed)
+    sample_indices = set(rng.sample(range(num_ids),
+                                    min(num_lookups, num_ids)))
+    present = []
+    # IDs that are not in the filter, generated with another seed
+    missing = list(generate_ids(num_lookups, seed + 1))
+
+    baseline_rss = peak_rss()
+
+    with tempfile.TemporaryDirectory() as directory:
+        duplicates_filter = DiskTrieDuplicatesFilter(
+            directory, config['format'],
+            bloom_capacity=config['bloom'] and num_ids)
+
+        words = generate_ids(num_ids, seed)
+        start = time.perf_counter()
+        for i in range(0, num_ids, batch_size):
+            batch = list(itertools.islice(words, batch_size))
+            duplicates_filter.add_words_if_new(batch)
+            present.extend(word for j, word in enumerate(batch, i)
+                           if j in sample_indices)
+        insert_seconds = time.perf_counter() - start
+        rng.shuffle(present)
+
+        duplicates_filter.compact()
+        duplicates_filter.close()
+        bytes_on_disk = directory_size(directory)
+
+        # lookups with a freshly opened filter, like a new spider run
+        duplicates_filter = DiskTrieDuplicatesFilter(
+            directory, config['format'],
+            bloom_capacity=config['bloom'] and num_ids)
+        hits = time_lookups(duplicates_filter, present)
+        misses = time_lookups(duplicates_filter, missing)
+        duplicates_filter.close()
+
+    return {
+        'format': config['format'],
+        'bloom': config['bloom'],
+        'ids': num_ids,
+        'inserts_per_second': round(num_ids / insert_seconds),
+        'hit_p50_us': round(percentile(hits, 0.5) * 1e6, 1),
+        'hit_p99_us': round(percentile(hits, 0.99) * 1e6, 1),
+        'miss_p50_us': round(percentile(misses, 0.5) * 1e6, 1),
+        'miss_p99_us': round(percentile(misses, 0.99) * 1e6, 1),
+        'bytes_on_disk': bytes_on_disk,
+        'baseline_rss_bytes': baseline_rss,
+        # growth of the peak RSS while the filter was used
+        'peak_rss_bytes': peak_rss() - baseline_rss,
+    }
+
+
+def _run_in_child(queue, *args):
+    queue.put(run_benchmark(*args))
+
+
+@click.command()
+@click.option('--scale', default=1.0, type=float,
+              help='Fraction of the production corpus of 8.5M IDs')
+@click.option('--formats', default='text,sorted,frontcoded,digest',
+              help='Comma separated list of bucket formats')
+@click.option('--bloom/--no-bloom', default=True,
+              help='Also run each format with a bloom filter')
+@click.option('--lookups', default=10000, type=int,
+              help='Number of hit and miss lookups each')
+@click.option('--batch-size', default=1000, type=int,
+              help='Number of IDs per add_words_if_new call')
+@click.option('--seed', default=42, type=int)
+def main(scale, formats, bloom, lookups, batch_size, seed):
+    num_ids = max(1, int(PRODUCTION_IDS * scale))
+
+    configs = [{'format': f, 'bloom': False} for f in formats.split(',')]
+    if bloom:
+        configs += [{'format': f, 'bloom': True} for f in formats.split(',')]
+
+    context = multiprocessing.get_context('spawn')
+    for config in configs:
+        queue = context.Queue()
+        process = context.Process(
+            target=_run_in_child,
+            args=(queue, config, num_ids, lookups, batch_size, seed))
+        process.start()
+        result = queue.get()
+        process.join()
+
+        print(json.dumps(result))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
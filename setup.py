@@ -7,6 +7,8 @@ extras = {
     'mqtt': ['paho-mqtt'],
     'redis': ['redis'],
     'chrome': ['pyppeteer'],
+    'zstd': ['zstandard'],
+    'parquet': ['pyarrow'],
 }
 extras['all'] = [package for packages in extras.values()
                  for package in packages]
@@ -37,5 +39,6 @@ setup(
         skyscraper=skyscraper.commands:skyscraper_service
         skyscraper-spider=skyscraper.commands:skyscraper_spider
         skyscraper-archive=skyscraper.commands:skyscraper_archive
+        skyscraper-dedup-convert=skyscraper.commands:skyscraper_dedup_convert
     ''',
 )
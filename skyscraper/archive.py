@@ -2,55 +2,350 @@ import datetime
 import os
 import json
 import gzip
+import contextlib
+import collections
 
+import skyscraper.instrumentation
 
-def oldest_file_and_date(folder):
-    try:
-        filepaths = [os.path.join(folder, fn) for fn in os.listdir(folder)]
-        oldest_file = min(filepaths, key=os.path.getmtime)
 
-        oldest_date = datetime.datetime.utcfromtimestamp(
-            os.path.getmtime(oldest_file))
+ARCHIVE_SUFFIX = '.jl.gz'
+INDEX_SUFFIX = '.idx'
+MANIFEST_FILENAME = '.archive-manifest.json'
 
-        return oldest_file, oldest_date
-    except ValueError:
-        return None, None
+# uncompressed size of the independently compressed blocks of an archive
+BLOCK_SIZE = 256 * 1024
 
 
-def files_in_date_range(folder, from_date, to_date_open_interval):
-    relevant = []
+def files_by_month(directory, date_stop):
+    """Return the item files in `directory` that were last modified before
+    `date_stop`, grouped by (year, month). The directory is listed and
+    each file is stat'ed exactly once.
+    """
+    months = collections.defaultdict(list)
 
-    filepaths = [os.path.join(folder, fn) for fn in os.listdir(folder)]
-    for filepath in filepaths:
-        d = datetime.datetime.utcfromtimestamp(os.path.getmtime(filepath))
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # hidden files are segments that are still being written
+            if entry.name.startswith('.') \
+                    or entry.name.endswith(ARCHIVE_SUFFIX) \
+                    or entry.name.endswith(ARCHIVE_SUFFIX + INDEX_SUFFIX) \
+                    or not entry.is_file():
+                continue
 
-        if from_date <= d < to_date_open_interval:
-            relevant.append(filepath)
+            d = datetime.datetime.utcfromtimestamp(entry.stat().st_mtime)
+            if d < date_stop:
+                months[(d.year, d.month)].append(entry.path)
 
-    return relevant
+    return months
 
 
 def archive_old_files(directory):
+    """Append all files of previous months to the archive of their month.
+
+    Archiving is transactional: the manifest (a hidden file in the
+    directory) records the committed size of each archive before and
+    after data is appended, and the inputs of the last committed batch.
+    If a run is interrupted, the next run cuts off partially appended
+    data and removes inputs that were archived but not deleted, then
+    continues with the remaining files.
+    """
     today = datetime.datetime.today()
     date_stop = datetime.datetime(today.year, today.month, 1)
 
-    oldest_file, oldest_date = oldest_file_and_date(directory)
-    while oldest_file and oldest_date < date_stop:
-        month_begin = datetime.datetime(oldest_date.year, oldest_date.month, 1)
-        plus_month = month_begin + datetime.timedelta(days=31)
-        month_end = datetime.datetime(plus_month.year, plus_month.month, 1)
+    manifest = read_manifest(directory)
+    _recover(directory, manifest)
+
+    for (year, month), filepaths in sorted(
+            files_by_month(directory, date_stop).items()):
+        filename = datetime.date(year, month, 1).strftime('%Y-%m.jl.gz')
+        _archive_month(directory, manifest, filename, sorted(filepaths))
+
+
+def _archive_month(directory, manifest, filename, filepaths):
+    gzippath = os.path.join(directory, filename)
+    indexpath = gzippath + INDEX_SUFFIX
+
+    entry = manifest.get(filename)
+    if entry is None:
+        if os.path.isfile(gzippath):
+            # archives of older versions are complete, but they might
+            # have no index. Appending an index for new items only would
+            # hide the old ones from lookups.
+            entry = {
+                'size': os.path.getsize(gzippath),
+                'indexed': os.path.isfile(indexpath),
+                'index_size': os.path.getsize(indexpath)
+                if os.path.isfile(indexpath) else 0,
+                'files': 0,
+            }
+        else:
+            entry = {'size': 0, 'indexed': True, 'index_size': 0,
+                     'files': 0}
+
+    # phase 1: record what is committed, everything after it is discarded
+    # if this run does not finish
+    entry['pending'] = True
+    entry['inputs'] = []
+    manifest[filename] = entry
+    _save_manifest(directory, manifest)
+
+    new_archive = entry['size'] == 0
+    if new_archive:
+        # a new month is written completely before it gets its name
+        target, target_index = _tmp_path(gzippath), _tmp_path(indexpath)
+        mode = 'wb'
+    else:
+        target, target_index = gzippath, indexpath
+        mode = 'ab'
+
+    with open(target, mode) as f, \
+            _open_index(target_index, entry['indexed'], mode) as index:
+        writer = BlockWriter(f, index)
+        for filepath in filepaths:
+            for line in _item_lines(filepath):
+                writer.write(line)
+        writer.close()
+
+        f.flush()
+        os.fsync(f.fileno())
+        if index is not None:
+            index.flush()
+            os.fsync(index.fileno())
+
+    if new_archive:
+        os.rename(target, gzippath)
+        if entry['indexed']:
+            os.rename(target_index, indexpath)
+        skyscraper.instrumentation.count_files(
+            directory, 2 if entry['indexed'] else 1)
+
+    # phase 2: commit, from now on the inputs are part of the archive
+    entry['size'] = os.path.getsize(gzippath)
+    if entry['indexed']:
+        entry['index_size'] = os.path.getsize(indexpath)
+    entry['files'] += len(filepaths)
+    entry['pending'] = False
+    entry['inputs'] = [os.path.basename(path) for path in filepaths]
+    _save_manifest(directory, manifest)
+
+    _remove_inputs(directory, entry)
+    _save_manifest(directory, manifest)
+
 
-        filename = month_begin.strftime('%Y-%m.jl.gz')
+def _recover(directory, manifest):
+    changed = False
+    for filename, entry in manifest.items():
         gzippath = os.path.join(directory, filename)
+        indexpath = gzippath + INDEX_SUFFIX
+
+        if entry.get('pending'):
+            # cut off data of an interrupted run, its inputs still exist
+            for path in (_tmp_path(gzippath), _tmp_path(indexpath)):
+                if os.path.isfile(path):
+                    os.remove(path)
+            if entry['size'] > 0:
+                os.truncate(gzippath, entry['size'])
+                if entry['indexed']:
+                    os.truncate(indexpath, entry['index_size'])
+            entry['pending'] = False
+            changed = True
+
+        if entry.get('inputs'):
+            _remove_inputs(directory, entry)
+            changed = True
+
+    if changed:
+        _save_manifest(directory, manifest)
+
+
+def _remove_inputs(directory, entry):
+    removed = 0
+    for name in entry['inputs']:
+        try:
+            os.remove(os.path.join(directory, name))
+            removed += 1
+        except FileNotFoundError:
+            pass
+    entry['inputs'] = []
+
+    if removed:
+        skyscraper.instrumentation.count_files(directory, -removed)
+
+
+def _open_index(path, indexed, mode):
+    if not indexed:
+        return contextlib.nullcontext()
+    return open(path, mode)
+
+
+def _tmp_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.{}.tmp'.format(name))
+
+
+def read_manifest(directory):
+    """Return the archiving state of a directory: for each archive its
+    committed size, whether it has an index, the number of archived
+    files and the inputs of the last batch that still have to be
+    removed.
+    """
+    try:
+        with open(os.path.join(directory, MANIFEST_FILENAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _save_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST_FILENAME)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+def _item_lines(filepath):
+    """Return the items of one file as JSON lines, without parsing them
+    if possible.
+    """
+    with open(filepath, 'rb') as fin:
+        if filepath.endswith('.jl'):
+            # segments contain one item per line already
+            return [line.rstrip(b'\n') for line in fin if line.strip()]
+
+        data = fin.read().strip()
+
+    # items written by skyscraper are on one line, everything else has
+    # to be reformatted
+    if b'\n' in data:
+        data = json.dumps(json.loads(data.decode('utf-8'))).encode('utf-8')
+
+    return [data]
+
+
+class BlockWriter(object):
+    """Writes JSON lines into a gzip file made of independently compressed
+    blocks of about `block_size` bytes. The result is a normal gzip file
+    (several gzip members), but each block can also be decompressed on
+    its own.
+
+    For each item the sidecar `index` (a binary file or None) gets one
+    JSON line `[id, crawl_time, block offset, block length]`.
+    """
+    def __init__(self, f, index, block_size=BLOCK_SIZE):
+        self.f = f
+        self.index = index
+        self.block_size = block_size
+
+        self._lines = []
+        self._keys = []
+        self._size = 0
+
+    def write(self, line):
+        try:
+            item = json.loads(line)
+            self._keys.append((item.get('id'), item.get('crawl_time')))
+        except ValueError:
+            self._keys.append((None, None))
+
+        self._lines.append(line)
+        self._size += len(line) + 1
+        if self._size >= self.block_size:
+            self._flush_block()
+
+    def close(self):
+        self._flush_block()
+
+    def _flush_block(self):
+        if not self._lines:
+            return
+
+        block = gzip.compress(b'\n'.join(self._lines) + b'\n')
+        offset = self.f.tell()
+        self.f.write(block)
+
+        if self.index is not None:
+            for id_, crawl_time in self._keys:
+                self.index.write(json.dumps(
+                    [id_, crawl_time, offset, len(block)]).encode('utf-8')
+                    + b'\n')
+
+        self._lines = []
+        self._keys = []
+        self._size = 0
+
+
+class ArchiveReader(object):
+    """Reads the items of a monthly archive.
+
+    `items` streams all items, `find` only decompresses the blocks that
+    contain the requested ID and `items_between` only the blocks with
+    items of the requested crawl time range. Archives without index are
+    scanned completely.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._index = None
+
+    def items(self, predicate=None):
+        """Yield all items (for which `predicate` is true) lazily."""
+        with gzip.open(self.path, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                if predicate is None or predicate(item):
+                    yield item
+
+    def __iter__(self):
+        return self.items()
+
+    def find(self, id_):
+        """Return the item with the ID or None."""
+        index = self._load_index()
+        if index is None:
+            return next(self.items(lambda item: item.get('id') == id_), None)
+
+        blocks = sorted(set((offset, length)
+                            for entry_id, _, offset, length in index
+                            if entry_id == id_))
+        for item in self._block_items(blocks):
+            if item.get('id') == id_:
+                return item
+        return None
+
+    def items_between(self, from_time, to_time):
+        """Yield the items with `from_time <= crawl_time < to_time`. Times
+        are strings in the format of `crawl_time`.
+        """
+        def in_range(item):
+            return item.get('crawl_time') is not None \
+                and from_time <= item['crawl_time'] < to_time
+
+        index = self._load_index()
+        if index is None:
+            yield from self.items(in_range)
+            return
 
-        relevant_files = files_in_date_range(directory, month_begin, month_end)
-        with gzip.open(gzippath, 'wt') as f:
-            for filepath in relevant_files:
-                with open(filepath) as fin:
-                    data = json.load(fin)
-                    f.write(json.dumps(data) + '\n')
+        blocks = sorted(set(
+            (offset, length) for _, crawl_time, offset, length in index
+            if crawl_time is not None and from_time <= crawl_time < to_time))
+        for item in self._block_items(blocks):
+            if in_range(item):
+                yield item
 
-        for filepath in relevant_files:
-            os.remove(filepath)
+    def _block_items(self, blocks):
+        with open(self.path, 'rb') as f:
+            for offset, length in blocks:
+                f.seek(offset)
+                for line in gzip.decompress(f.read(length)).splitlines():
+                    if line.strip():
+                        yield json.loads(line)
 
-        oldest_file, oldest_date = oldest_file_and_date(directory)
+    def _load_index(self):
+        if self._index is None and os.path.isfile(self.path + INDEX_SUFFIX):
+            with open(self.path + INDEX_SUFFIX) as f:
+                self._index = [json.loads(line) for line in f]
+        return self._index
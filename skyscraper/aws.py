@@ -0,0 +1,50 @@
+import threading
+
+import boto3
+import botocore.config
+
+
+_resources = {}
+_resources_lock = threading.Lock()
+
+
+def get_resource(service_name, settings):
+    """Return a boto3 resource for `service_name` that is shared by all
+    users with the same settings in this process, so that they also share
+    one connection pool.
+
+    Pool size, TCP keep-alive and region are taken from the settings
+    AWS_MAX_POOL_CONNECTIONS, AWS_TCP_KEEPALIVE and AWS_REGION.
+    """
+    access_key = settings.get('AWS_ACCESS_KEY')
+    secret_access_key = settings.get('AWS_SECRET_ACCESS_KEY')
+    region = settings.get('AWS_REGION') or 'us-east-1'
+    pool_size = settings.getint('AWS_MAX_POOL_CONNECTIONS', 10)
+    keepalive = settings.getbool('AWS_TCP_KEEPALIVE', True)
+
+    key = (service_name, access_key, secret_access_key, region, pool_size,
+           keepalive)
+
+    # boto3 sessions are not thread-safe, create resources one at a time
+    with _resources_lock:
+        try:
+            return _resources[key]
+        except KeyError:
+            session = boto3.Session(
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_access_key,
+                region_name=region
+            )
+            config = botocore.config.Config(
+                max_pool_connections=pool_size,
+                tcp_keepalive=keepalive)
+
+            resource = session.resource(service_name, config=config)
+            _resources[key] = resource
+            return resource
+
+
+def clear_resources():
+    """Forget all shared resources, e.g. after a fork."""
+    with _resources_lock:
+        _resources.clear()
@@ -0,0 +1,96 @@
+"""Batching of pipeline work, e.g. to check or store many item IDs with
+one request.
+"""
+
+import time
+
+from scrapy.exceptions import DropItem
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+
+class Batch(object):
+    """Collects entries and passes them as a list to `process`, once
+    `max_size` entries are pending or the oldest pending entry is
+    `max_age` seconds old.
+
+    Scrapy waits for all items of a response before it continues, so if
+    `timer` is set, a timer of the twisted reactor makes sure that small
+    batches get flushed. Other engines (e.g. chrome) do not run the
+    reactor, then the age is only checked when an entry is added.
+    """
+    def __init__(self, process, max_size, max_age=None, timer=True):
+        self.process = process
+        self.max_size = max_size
+        self.max_age = max_age
+        self.timer = timer
+
+        self._entries = []
+        self._started = None
+        self._flush_call = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, entry):
+        self._entries.append(entry)
+        if self._started is None:
+            self._started = time.monotonic()
+
+        if len(self._entries) >= self.max_size or self._expired():
+            self.flush()
+        elif self.timer and self.max_age and self._flush_call is None:
+            from twisted.internet import reactor
+            self._flush_call = reactor.callLater(self.max_age, self.flush)
+
+    def flush(self):
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+
+        entries, self._entries = self._entries, []
+        self._started = None
+        if entries:
+            self.process(entries)
+
+    def _expired(self):
+        return bool(self.max_age) \
+            and time.monotonic() - self._started >= self.max_age
+
+
+class DuplicatesBatch(Batch):
+    """Batch of items that are checked for duplicates together.
+
+    `add` returns a Deferred that fires with the item, or fails with
+    `DropItem` if the item is a duplicate. `find_new` is called with the
+    keys of a batch and returns the keys that have not been seen before.
+    """
+    def __init__(self, find_new, max_size, max_age=None):
+        super().__init__(self._check, max_size, max_age)
+        self.find_new = find_new
+
+    def add(self, key, item):
+        d = defer.Deferred()
+        super().add((key, item, d))
+        return d
+
+    def _check(self, pending):
+        try:
+            new_keys = set(self.find_new([key for key, _, _ in pending]))
+        except Exception:
+            # scrapy waits for each pending item, so all of them have to
+            # fail, otherwise the spider never finishes
+            failure = Failure()
+            for _, _, d in pending:
+                d.errback(failure)
+            return
+
+        for key, item, d in pending:
+            if key in new_keys:
+                # the same key might occur several times within one batch
+                new_keys.remove(key)
+                d.callback(item)
+            else:
+                d.errback(DropItem(
+                    "URL '%s' with item ID '%s' has already been crawled"
+                    % (item['url'], item['id'])))
@@ -0,0 +1,64 @@
+import hashlib
+
+import skyscraper.compression
+from skyscraper.deduplication import RecentWordsCache
+
+
+REFERENCE_PREFIX = 'sha256:'
+
+
+class BlobStore(object):
+    """Content-addressed store for large values like the source of items.
+
+    Each blob is stored once under the SHA-256 digest of its content,
+    compressed with `compression`. `put` returns a reference like
+    `sha256:<hex digest>` that can be resolved with `get`. The backend
+    is a storage of `skyscraper.storage` and decides where blobs are
+    stored.
+    """
+    def __init__(self, backend, compression='zstd', cache_size=10000):
+        self.backend = backend
+        self.compression = compression
+
+        # blobs that are known to exist, e.g. pages that did not change.
+        # These lookups are no deduplication, so they are not counted.
+        self._known = RecentWordsCache(cache_size, metric_label=None)
+
+    def put(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        digest = hashlib.sha256(data).hexdigest()
+        key = self._key(digest)
+
+        if not self._known.lookup(key):
+            if not self.backend.exists(key):
+                self.backend.write(key, skyscraper.compression.compress(
+                    data, self.compression))
+            self._known.add(key)
+
+        return REFERENCE_PREFIX + digest
+
+    def get(self, reference):
+        """Return the content of a reference as bytes."""
+        if not reference.startswith(REFERENCE_PREFIX):
+            raise ValueError('Invalid blob reference "{}"'.format(reference))
+
+        key = self._key(reference[len(REFERENCE_PREFIX):])
+        return skyscraper.compression.decompress(
+            self.backend.read(key), self.compression)
+
+    def _key(self, digest):
+        # two levels keep the number of entries per folder small
+        return '{}/{}{}'.format(
+            digest[0:2], digest,
+            skyscraper.compression.EXTENSIONS[self.compression])
+
+
+def resolve_source(item, store):
+    """Return the source of an item that might have been stored in a
+    blob store by `StoreSourceInBlobStorePipeline`.
+    """
+    if item.get('source_ref'):
+        return store.get(item['source_ref']).decode('utf-8')
+    return item.get('source')
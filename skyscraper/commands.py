@@ -3,12 +3,15 @@ import os
 import time
 import logging
 import prometheus_client
+import prometheus_client.multiprocess
 import asyncio
+import concurrent.futures
 import importlib
 import pyppeteer
 from scrapy.utils.project import get_project_settings
 
 import skyscraper.archive
+import skyscraper.deduplication
 import skyscraper.execution
 import skyscraper.git
 import skyscraper.mail
@@ -22,7 +25,14 @@ def skyscraper_service():
     """Runs the skyscraper service which determines when spiders have to be
     executed and executes them"""
 
-    prometheus_client.start_http_server(8000)
+    # spiders run in subprocesses, their metrics are only collected if
+    # prometheus_client runs in multiprocess mode
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = prometheus_client.CollectorRegistry()
+        prometheus_client.multiprocess.MultiProcessCollector(registry)
+        prometheus_client.start_http_server(8000, registry=registry)
+    else:
+        prometheus_client.start_http_server(8000)
     prometheus_num_configs = prometheus_client.Gauge(
         'skyscraper_git_spiders',
         'Number of spiders available in the Skyscraper git repository')
@@ -48,8 +58,14 @@ def skyscraper_service():
     crawler = skyscraper.execution.ChromeCrawler(
         settings, browser)
 
+    run_history = None
+    if skyscraper.settings.RUN_HISTORY_FILE:
+        run_history = skyscraper.instrumentation.RunHistory(
+            skyscraper.settings.RUN_HISTORY_FILE,
+            skyscraper.settings.RUN_HISTORY_SIZE)
+
     spider_runners = {
-        'scrapy': skyscraper.execution.ScrapySpiderRunner(proxy),
+        'scrapy': skyscraper.execution.ScrapySpiderRunner(proxy, run_history),
         'chrome': skyscraper.execution.ChromeSpiderRunner(
             crawler, spiderloader, pipelines),
     }
@@ -123,19 +139,94 @@ def skyscraper_spider(namespace, spider, engine, use_tor):
 
 
 @click.command()
-def skyscraper_archive():
+@click.option('--jobs', default=os.cpu_count(), type=int,
+              help='Number of spider folders archived in parallel')
+def skyscraper_archive(jobs):
     """Archive files from previous months into gzip files."""
 
     root_folder = skyscraper.settings.SKYSCRAPER_STORAGE_FOLDER_PATH
+    spider_folders = []
     for project in os.listdir(root_folder):
         if os.path.isdir(os.path.join(root_folder, project)):
             for spider in os.listdir(os.path.join(root_folder, project)):
                 if os.path.isdir(os.path.join(root_folder, project, spider)):
-                    click.echo('Archiving old files for {}/{}'.format(
-                        project, spider))
+                    spider_folders.append((project, spider))
+
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max(1, jobs)) as executor:
+        futures = {
+            executor.submit(skyscraper.archive.archive_old_files,
+                            os.path.join(root_folder, project, spider)):
+            (project, spider)
+            for project, spider in spider_folders
+        }
+
+        for future in concurrent.futures.as_completed(futures):
+            project, spider = futures[future]
+            try:
+                future.result()
+                click.echo('Archived old files for {}/{}'.format(
+                    project, spider))
+            except Exception as e:
+                logging.error('Could not archive {}/{}: {}'.format(
+                    project, spider, e))
+                failed.append('{}/{}'.format(project, spider))
+
+    # IDs of expiring deduplication filters are removed in the same job
+    dedup_folder = getattr(
+        skyscraper.settings, 'DISK_DEDUPLICATION_FOLDER', None)
+    if dedup_folder and os.path.isdir(dedup_folder):
+        expired = skyscraper.deduplication.expire_all_generations(
+            dedup_folder)
+        click.echo('Removed {} expired deduplication generations'.format(
+            expired))
+
+    if failed:
+        raise click.ClickException(
+            'Archiving failed for {}'.format(', '.join(sorted(failed))))
 
-                    skyscraper.archive.archive_old_files(
-                        os.path.join(root_folder, project, spider))
+
+@click.command()
+@click.argument('target_format')
+@click.option('--folder', envvar='SKYSCRAPER_DISK_DEDUPLICATION_FOLDER',
+              required=True, help='Folder of the disk duplicates filter')
+@click.option('--source-format', default=None,
+              help='Current format of the buckets (detected if not set)')
+def skyscraper_dedup_convert(target_format, folder, source_format):
+    """Convert the buckets of the disk duplicates filter to another
+    format. If source and target format are the same, the buckets are
+    compacted."""
+
+    found_formats = skyscraper.deduplication.detect_bucket_formats(folder)
+    if source_format is None:
+        if len(found_formats) > 1:
+            raise click.ClickException(
+                'Found buckets in several formats ({}), use --source-format '
+                'to select one'.format(', '.join(sorted(found_formats))))
+        elif not found_formats:
+            click.echo('No buckets found in {}'.format(folder))
+            return
+
+        source_format = found_formats.pop()
+    elif found_formats - {source_format}:
+        raise click.ClickException(
+            'Found buckets in format {} in {}, but source format is {}'.format(
+                ', '.join(sorted(found_formats - {source_format})), folder,
+                source_format))
+
+    click.echo('Converting {} from {} to {}'.format(
+        folder, source_format, target_format))
+
+    duplicates_filter = skyscraper.deduplication.DiskTrieDuplicatesFilter(
+        folder, source_format)
+    duplicates_filter.convert_to(target_format).close()
+
+    remaining = skyscraper.deduplication.detect_bucket_formats(folder) \
+        - {target_format}
+    if remaining:
+        raise click.ClickException(
+            'Buckets in format {} remain in {}'.format(
+                ', '.join(sorted(remaining)), folder))
 
 
 def _load_pipeline(name):
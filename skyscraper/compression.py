@@ -0,0 +1,44 @@
+import gzip
+
+
+# file extension of each compression method
+EXTENSIONS = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+def compress(data, method, level=None):
+    """Compress `data` (bytes) with `method`, which is None, "gzip" or
+    "zstd". zstd requires the optional `zstandard` package.
+    """
+    if method is None:
+        return data
+    elif method == 'gzip':
+        return gzip.compress(data, 6 if level is None else level)
+    elif method == 'zstd':
+        return _zstandard().ZstdCompressor(
+            level=3 if level is None else level).compress(data)
+    else:
+        raise ValueError('Unknown compression "{}"'.format(method))
+
+
+def decompress(data, method):
+    if method is None:
+        return data
+    elif method == 'gzip':
+        return gzip.decompress(data)
+    elif method == 'zstd':
+        return _zstandard().ZstdDecompressor().decompress(data)
+    else:
+        raise ValueError('Unknown compression "{}"'.format(method))
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError('zstd compression requires the zstandard '
+                           'package, install skyscraper[zstd]')
+    return zstandard
@@ -5,40 +5,1404 @@
 # - strings might have a very long common prefix
 
 import os
+import json
+import math
+import time
+import shutil
+import uuid
+import logging
+import fcntl
+import mmap
+import heapq
+import struct
 import hashlib
+import itertools
+import contextlib
+import collections
+import prometheus_client
 
 
-class DiskTrieDuplicatesFilter(object):
-    # TODO: This is the simplest approach possible.
-    # Check where this performs well and where we have to
-    # change things and then adjust
-    def __init__(self, trie_directory):
-        self.trie_directory = trie_directory
+DEDUPLICATION_CACHE_HITS = prometheus_client.Counter(
+    'skyscraper_dedup_cache_hits',
+    'Number of duplicate lookups answered by the cache of recent IDs',
+    ['filter'])
+DEDUPLICATION_CACHE_MISSES = prometheus_client.Counter(
+    'skyscraper_dedup_cache_misses',
+    'Number of duplicate lookups that had to check the filter itself',
+    ['filter'])
 
-    def add_word(self, word):
-        bucket = self._determine_bucket(word)
 
-        bucketfile = os.path.join(self.trie_directory, bucket)
-        with open(bucketfile, 'a+') as f:
-            f.write('{}\n'.format(word))
+class TextBucket(object):
+    """Unsorted bucket with one word per line. Lookups have to scan the
+    whole file, but writes are a simple append.
 
-    def has_word(self, word):
-        bucket = self._determine_bucket(word)
+    All bucket formats receive words as (digest, word) pairs, where the
+    digest is the SHA-256 digest the filter uses to determine the bucket.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def owns_file(filename):
+        return len(filename) == 2 and all(c in '0123456789abcdef'
+                                          for c in filename)
 
-        bucketfile = os.path.join(self.trie_directory, bucket)
-        if not os.path.isfile(bucketfile):
+    def add_many(self, entries):
+        with open(self.path, 'a+') as f:
+            f.write(''.join('{}\n'.format(word) for _, word in entries))
+
+    def contains(self, digest, word):
+        if not os.path.isfile(self.path):
             return False
 
-        with open(bucketfile, 'r') as f:
+        with open(self.path, 'r') as f:
             for line in f:
                 if line.strip() == word:
                     return True
 
         return False
 
-    def _determine_bucket(self, word):
-        # use the first two chars of the hash. This should produce a quite
+    def contains_many(self, entries):
+        wanted = set(word for _, word in entries)
+        found = set()
+        if not wanted or not os.path.isfile(self.path):
+            return found
+
+        with open(self.path, 'r') as f:
+            for line in f:
+                word = line.strip()
+                if word in wanted:
+                    found.add(word)
+                    if len(found) == len(wanted):
+                        break
+
+        return found
+
+    def words(self):
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, 'r') as f:
+            for line in f:
+                yield line.strip()
+
+    def digests(self):
+        for word in self.words():
+            yield _digest(word)
+
+    def compact(self):
+        pass
+
+    def rebuild(self, entries):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for _, word in entries:
+                f.write('{}\n'.format(word))
+
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        pass
+
+
+class SortedBucket(object):
+    """Bucket that consists of an immutable sorted segment and a small
+    append log.
+
+    New words are appended to the log. Lookups check the log (which is
+    held in memory as a set) and then run a binary search over the
+    memory-mapped segment, so that only a few pages of the segment have
+    to be touched. Once the log grows beyond a fraction of the segment
+    size it is merged into a new segment.
+    """
+    SEGMENT_SUFFIX = '.sorted'
+    LOG_SUFFIX = '.log'
+
+    # compact the log once it is larger than MIN_LOG_SIZE bytes and
+    # larger than 1/LOG_COMPACTION_RATIO of the segment, this keeps the
+    # amortized cost of rewriting the segment constant per added word
+    MIN_LOG_SIZE = 64 * 1024
+    LOG_COMPACTION_RATIO = 32
+
+    # each log starts with a random header, so that a reader can tell a
+    # recreated log apart from the one it has read before (the file
+    # system might reuse the inode number)
+    LOG_MAGIC = b'SKYLOG'
+    LOG_HEADER_SIZE = 16
+
+    def __init__(self, path):
+        self.segment_path = path + self.SEGMENT_SUFFIX
+        self.log_path = path + self.LOG_SUFFIX
+
+        self._segment = None
+        self._segment_stat = None
+
+        self._log_entries = set()
+        self._log_offset = 0
+        self._log_header = None
+        self._log_stat = None
+
+    @classmethod
+    def owns_file(cls, filename):
+        return filename[2:] in (cls.SEGMENT_SUFFIX, cls.LOG_SUFFIX)
+
+    def add_many(self, entries):
+        data = b''.join(self._log_record(self._key(digest, word))
+                        for digest, word in entries)
+        if not data:
+            return
+
+        self._append_log(data)
+
+        self._refresh_log()
+        if self._log_needs_compaction():
+            self.compact()
+
+    def contains(self, digest, word):
+        key = self._key(digest, word)
+
+        self._refresh_log()
+        if key in self._log_entries:
+            return True
+
+        return self._segment_contains(key)
+
+    def contains_many(self, entries):
+        self._refresh_log()
+
+        found = set()
+        for digest, word in entries:
+            key = self._key(digest, word)
+            if key in self._log_entries or self._segment_contains(key):
+                found.add(word)
+
+        return found
+
+    def words(self):
+        for key in self._merged_keys():
+            yield key.decode('utf-8')
+
+    def digests(self):
+        for word in self.words():
+            yield _digest(word)
+
+    def compact(self):
+        """Merge the append log into a new sorted segment. The new segment
+        is written to a temporary file and renamed afterwards, so that
+        readers always see a complete segment.
+
+        Writers hold a shared lock on the log while they append, the
+        compaction holds an exclusive lock until the merged log has been
+        removed. Thus, no append can get lost between reading the log and
+        removing it.
+        """
+        with self._exclusive_log() as exists:
+            if not exists:
+                return
+
+            self._refresh_log()
+            if self._log_entries:
+                self._replace_segment(self._merged_keys())
+            os.remove(self.log_path)
+
+        self._refresh_log()
+
+    def rebuild(self, entries):
+        """Replace the content of this bucket with the given words."""
+        keys = sorted(set(self._key(digest, word) for digest, word in entries))
+
+        with self._exclusive_log() as exists:
+            self._replace_segment(keys)
+            if exists:
+                os.remove(self.log_path)
+
+        self._refresh_log()
+
+    def remove(self):
+        self.close()
+        for path in [self.segment_path, self.log_path]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def close(self):
+        if self._segment is not None:
+            self._segment.close()
+
+        self._segment = None
+        self._segment_stat = None
+
+    def _merged_keys(self):
+        self._refresh_log()
+
+        merged = heapq.merge(self._segment_keys(), sorted(self._log_entries))
+        for key, _ in itertools.groupby(merged):
+            yield key
+
+    def _key(self, digest, word):
+        return word.encode('utf-8')
+
+    def _log_record(self, key):
+        return key + b'\n'
+
+    def _parse_log(self, data):
+        # only consume complete lines, a concurrent writer might
+        # not have finished its line yet
+        end = data.rfind(b'\n') + 1
+        return data[:end].splitlines(), end
+
+    def _replace_segment(self, keys):
+        tmp_path = self.segment_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            self._write_segment(f, keys)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, self.segment_path)
+
+    def _write_segment(self, f, keys):
+        for key in keys:
+            f.write(key + b'\n')
+
+    def _segment_keys(self):
+        if not os.path.isfile(self.segment_path):
+            return
+
+        with open(self.segment_path, 'rb') as f:
+            for line in f:
+                yield line.rstrip(b'\n')
+
+    def _segment_contains(self, key):
+        segment = self._load_segment()
+        if segment is None:
+            return False
+
+        # lo and hi always point to the beginning of a line (or the end
+        # of the segment)
+        lo, hi = 0, len(segment)
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            newline = segment.rfind(b'\n', lo, mid)
+            start = newline + 1 if newline >= 0 else lo
+            end = segment.find(b'\n', start)
+
+            line = segment[start:end]
+            if line == key:
+                return True
+            elif line < key:
+                lo = end + 1
+            else:
+                hi = start
+
+        return False
+
+    def _load_segment(self):
+        try:
+            st = os.stat(self.segment_path)
+        except FileNotFoundError:
+            self.close()
+            return None
+
+        # the segment is replaced on compaction (possibly by another
+        # filter instance), in this case we have to map the new file
+        stat = (st.st_ino, st.st_size)
+        if stat != self._segment_stat:
+            self.close()
+
+            if st.st_size == 0:
+                return None
+
+            with open(self.segment_path, 'rb') as f:
+                self._segment = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._segment_stat = stat
+
+        return self._segment
+
+    def _append_log(self, data):
+        while True:
+            try:
+                fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND)
+            except FileNotFoundError:
+                self._create_log()
+                continue
+
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+
+                # the log was merged and removed by a compaction while we
+                # were waiting for the lock, append to a new log instead
+                if os.fstat(fd).st_nlink == 0:
+                    continue
+
+                # a single write per batch, so that lines of concurrent
+                # writers do not get interleaved
+                os.write(fd, data)
+                return
+            finally:
+                os.close(fd)
+
+    @contextlib.contextmanager
+    def _exclusive_log(self):
+        """Lock the log exclusively, yields whether a log exists."""
+        try:
+            f = open(self.log_path, 'rb')
+        except FileNotFoundError:
+            yield False
+            return
+
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield os.fstat(f.fileno()).st_nlink > 0
+
+    def _create_log(self):
+        # the log is linked into place with its header already written,
+        # so it never exists without a header
+        tmp_path = '{}.{}.tmp'.format(self.log_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(self.LOG_MAGIC + os.urandom(
+                self.LOG_HEADER_SIZE - len(self.LOG_MAGIC)))
+
+        try:
+            os.link(tmp_path, self.log_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+
+    def _reset_log(self):
+        self._log_entries = set()
+        self._log_offset = 0
+        self._log_header = None
+        self._log_stat = None
+
+    def _refresh_log(self):
+        try:
+            st = os.stat(self.log_path)
+        except FileNotFoundError:
+            self._reset_log()
+            return
+
+        stat = (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+        if stat == self._log_stat:
+            return
+
+        try:
+            f = open(self.log_path, 'rb')
+        except FileNotFoundError:
+            self._reset_log()
+            return
+
+        with f:
+            header = f.read(self.LOG_HEADER_SIZE)
+            if header != self._log_header:
+                # this is a new log (e.g. after a compaction)
+                self._reset_log()
+                if len(header) < self.LOG_HEADER_SIZE:
+                    return
+                self._log_header = header
+                self._log_offset = self.LOG_HEADER_SIZE
+
+            f.seek(self._log_offset)
+            data = f.read()
+
+            entries, consumed = self._parse_log(data)
+            self._log_entries.update(entries)
+            self._log_offset += consumed
+            self._log_stat = stat
+
+    def _log_needs_compaction(self):
+        try:
+            segment_size = os.path.getsize(self.segment_path)
+        except FileNotFoundError:
+            segment_size = 0
+
+        threshold = max(self.MIN_LOG_SIZE,
+                        segment_size // self.LOG_COMPACTION_RATIO)
+        return self._log_offset > threshold
+
+
+class FrontCodedBucket(SortedBucket):
+    """Sorted bucket whose segment is stored with front coding.
+
+    IDs share very long prefixes, so each key only stores the length of
+    the prefix it shares with its predecessor and the remaining suffix.
+    Every RESTART_INTERVAL keys a block starts with a full key. An index
+    of block offsets at the end of the segment allows a binary search
+    over the blocks, afterwards only one block has to be decoded.
+
+    Layout: blocks, block offsets (uint64 each), footer.
+    """
+    SEGMENT_SUFFIX = '.fc'
+    LOG_SUFFIX = '.fclog'
+    RESTART_INTERVAL = 16
+
+    MAGIC = b'SKYFCSEG'
+    FOOTER = struct.Struct('<Q8s')
+    OFFSET = struct.Struct('<Q')
+
+    def _write_segment(self, f, keys):
+        offsets = []
+        position = 0
+        previous = b''
+
+        for i, key in enumerate(keys):
+            if i % self.RESTART_INTERVAL == 0:
+                offsets.append(position)
+                shared = 0
+            else:
+                shared = _common_prefix_length(previous, key)
+
+            entry = _encode_varint(shared) \
+                + _encode_varint(len(key) - shared) + key[shared:]
+            f.write(entry)
+            position += len(entry)
+            previous = key
+
+        for offset in offsets:
+            f.write(self.OFFSET.pack(offset))
+        f.write(self.FOOTER.pack(len(offsets), self.MAGIC))
+
+    def _segment_keys(self):
+        segment = self._load_segment()
+        if segment is None:
+            return
+
+        num_blocks, index_offset = self._read_footer(segment)
+        offset = 0
+        previous = b''
+        while offset < index_offset:
+            previous, offset = self._decode_entry(segment, offset, previous)
+            yield previous
+
+    def _segment_contains(self, key):
+        segment = self._load_segment()
+        if segment is None:
+            return False
+
+        num_blocks, index_offset = self._read_footer(segment)
+
+        # find the last block whose first key is not larger than the key
+        lo, hi = 0, num_blocks
+        while lo < hi:
+            mid = (lo + hi) // 2
+            first_key, _ = self._decode_entry(
+                segment, self._block_offset(segment, index_offset, mid), b'')
+            if first_key <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == 0:
+            return False
+
+        offset = self._block_offset(segment, index_offset, lo - 1)
+        if lo < num_blocks:
+            end = self._block_offset(segment, index_offset, lo)
+        else:
+            end = index_offset
+
+        current = b''
+        while offset < end:
+            current, offset = self._decode_entry(segment, offset, current)
+            if current == key:
+                return True
+            elif current > key:
+                return False
+
+        return False
+
+    def _read_footer(self, segment):
+        num_blocks, magic = self.FOOTER.unpack_from(
+            segment, len(segment) - self.FOOTER.size)
+        if magic != self.MAGIC:
+            raise ValueError(
+                '{} is not a front coded segment'.format(self.segment_path))
+
+        index_offset = len(segment) - self.FOOTER.size \
+            - num_blocks * self.OFFSET.size
+        return num_blocks, index_offset
+
+    def _block_offset(self, segment, index_offset, block):
+        return self.OFFSET.unpack_from(
+            segment, index_offset + block * self.OFFSET.size)[0]
+
+    def _decode_entry(self, segment, offset, previous):
+        shared, offset = _decode_varint(segment, offset)
+        length, offset = _decode_varint(segment, offset)
+        key = previous[:shared] + segment[offset:offset + length]
+        return key, offset + length
+
+
+class DigestBucket(SortedBucket):
+    """Sorted bucket that only stores the first DIGEST_SIZE bytes of the
+    SHA-256 digest of each word as packed fixed-width records. Lookups
+    compare raw records without any text decoding.
+
+    The original words cannot be restored from this format. Two different
+    words are only confused if their digests share the first 128 bits.
+    For n stored words, a lookup of a new word returns a false positive
+    with a probability of at most n / 2**128 (about 2.5e-32 for 8.5
+    million words) and the probability of any collision among the stored
+    words is at most n**2 / 2**129 (about 1e-25).
+    """
+    SEGMENT_SUFFIX = '.digests'
+    LOG_SUFFIX = '.digestlog'
+    DIGEST_SIZE = 16
+
+    def words(self):
+        raise TypeError('Digest buckets do not store the original words')
+
+    def digests(self):
+        return self._merged_keys()
+
+    def _key(self, digest, word):
+        # the filter has already hashed the word to find the bucket
+        return digest[0:self.DIGEST_SIZE]
+
+    def _log_record(self, key):
+        return key
+
+    def _parse_log(self, data):
+        end = len(data) - len(data) % self.DIGEST_SIZE
+        entries = [data[i:i + self.DIGEST_SIZE]
+                   for i in range(0, end, self.DIGEST_SIZE)]
+        return entries, end
+
+    def _write_segment(self, f, keys):
+        for key in keys:
+            f.write(key)
+
+    def _segment_keys(self):
+        segment = self._load_segment()
+        if segment is None:
+            return
+
+        for offset in range(0, len(segment), self.DIGEST_SIZE):
+            yield segment[offset:offset + self.DIGEST_SIZE]
+
+    def _segment_contains(self, key):
+        segment = self._load_segment()
+        if segment is None:
+            return False
+
+        size = self.DIGEST_SIZE
+        lo, hi = 0, len(segment) // size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = segment[mid * size:(mid + 1) * size]
+            if record == key:
+                return True
+            elif record < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return False
+
+
+def _digest(word):
+    return hashlib.sha256(word.encode('utf-8')).digest()
+
+
+def _common_prefix_length(a, b):
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+
+    return length
+
+
+def _encode_varint(value):
+    result = bytearray()
+    while value >= 0x80:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def _decode_varint(buf, offset):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[offset]
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, offset
+        shift += 7
+
+
+class BloomFilter(object):
+    """Persistent bloom filter that is stored in a memory-mapped file.
+
+    Keys are SHA-256 digests, the bit positions are derived from the
+    digest with double hashing, so no additional hashing is needed.
+
+    Besides the parameters, the header stores the number of added keys,
+    the write generation of the buckets the filter is in sync with, and
+    the boot ID and number of processes that have the filter open, which
+    is required to detect if bits might have been lost in an OS crash.
+    """
+    MAGIC = b'SKYBLOOM'
+    HEADER = struct.Struct('<8sQQ')
+    HEADER_SIZE = 64
+
+    # offsets of the mutable header fields
+    COUNT_OFFSET = 24
+    GENERATION_OFFSET = 32
+    OPEN_COUNT_OFFSET = 40
+    BOOT_ID_OFFSET = 48
+    BOOT_ID_SIZE = 16
+
+    FIELD = struct.Struct('<Q')
+
+    def __init__(self, path):
+        with open(path, 'r+b') as f:
+            self._bits = mmap.mmap(f.fileno(), 0)
+
+        magic, self.num_bits, self.num_hashes = \
+            self.HEADER.unpack_from(self._bits)
+        if magic != self.MAGIC or len(self._bits) != \
+                self.HEADER_SIZE + (self.num_bits + 7) // 8:
+            self.close()
+            raise ValueError('{} is not a bloom filter file'.format(path))
+
+    @classmethod
+    def create(cls, path, num_bits, num_hashes, keys=()):
+        """Create a new bloom filter file and add all given keys. The
+        filter is built in a temporary file and then renamed, so that an
+        interrupted build never leaves an incomplete filter behind.
+        """
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, num_bits, num_hashes))
+            f.truncate(cls.HEADER_SIZE + (num_bits + 7) // 8)
+
+        bloom = cls(tmp_path)
+        for key in keys:
+            bloom.add(key)
+            bloom.count += 1
+        bloom.close()
+
+        os.replace(tmp_path, path)
+        return cls(path)
+
+    @staticmethod
+    def optimal_parameters(capacity, error_rate):
+        """Number of bits and hash functions for a filter that holds
+        `capacity` keys with the given false positive rate.
+        """
+        num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+        return num_bits, num_hashes
+
+    @property
+    def count(self):
+        return self._read_field(self.COUNT_OFFSET)
+
+    @count.setter
+    def count(self, value):
+        self._write_field(self.COUNT_OFFSET, value)
+
+    @property
+    def generation(self):
+        return self._read_field(self.GENERATION_OFFSET)
+
+    @generation.setter
+    def generation(self, value):
+        self._write_field(self.GENERATION_OFFSET, value)
+
+    @property
+    def open_count(self):
+        return self._read_field(self.OPEN_COUNT_OFFSET)
+
+    @open_count.setter
+    def open_count(self, value):
+        self._write_field(self.OPEN_COUNT_OFFSET, value)
+
+    @property
+    def boot_id(self):
+        return self._bits[self.BOOT_ID_OFFSET:
+                          self.BOOT_ID_OFFSET + self.BOOT_ID_SIZE]
+
+    @boot_id.setter
+    def boot_id(self, value):
+        value = value[:self.BOOT_ID_SIZE].ljust(self.BOOT_ID_SIZE, b'\0')
+        self._bits[self.BOOT_ID_OFFSET:
+                   self.BOOT_ID_OFFSET + self.BOOT_ID_SIZE] = value
+
+    def add(self, key):
+        for position in self._positions(key):
+            offset = self.HEADER_SIZE + (position >> 3)
+            self._bits[offset] |= 1 << (position & 7)
+
+    def might_contain(self, key):
+        for position in self._positions(key):
+            offset = self.HEADER_SIZE + (position >> 3)
+            if not self._bits[offset] & (1 << (position & 7)):
+                return False
+
+        return True
+
+    def flush(self):
+        """Write all changes to disk (msync)."""
+        self._bits.flush()
+
+    def close(self):
+        if not self._bits.closed:
+            self._bits.flush()
+            self._bits.close()
+
+    def _read_field(self, offset):
+        return self.FIELD.unpack_from(self._bits, offset)[0]
+
+    def _write_field(self, offset, value):
+        self.FIELD.pack_into(self._bits, offset, value)
+
+    def _positions(self, key):
+        h1 = int.from_bytes(key[0:8], 'little')
+        h2 = int.from_bytes(key[8:16], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+
+class _GenerationCounter(object):
+    """Memory-mapped counter that is incremented on every write to the
+    buckets, no matter whether the writer uses a bloom filter or not.
+    """
+    FIELD = struct.Struct('<Q')
+
+    def __init__(self, path):
+        with open(path, 'a+b') as f:
+            if os.fstat(f.fileno()).st_size < self.FIELD.size:
+                f.truncate(self.FIELD.size)
+            self._mmap = mmap.mmap(f.fileno(), self.FIELD.size)
+
+    @property
+    def value(self):
+        return self.FIELD.unpack_from(self._mmap)[0]
+
+    def increment(self):
+        value = self.value + 1
+        self.FIELD.pack_into(self._mmap, 0, value)
+        return value
+
+    def close(self):
+        if not self._mmap.closed:
+            self._mmap.flush()
+            self._mmap.close()
+
+
+def _boot_id():
+    try:
+        with open('/proc/sys/kernel/random/boot_id', 'rb') as f:
+            return uuid.UUID(f.read().strip().decode('ascii')).bytes
+    except (OSError, ValueError):
+        # without a boot ID we cannot detect reboots
+        return b''
+
+
+BUCKET_FORMATS = {
+    'text': TextBucket,
+    'sorted': SortedBucket,
+    'frontcoded': FrontCodedBucket,
+    'digest': DigestBucket,
+}
+
+
+class RecentWordsCache(object):
+    """Bounded LRU cache of words that are known to be stored in the
+    filter. Words are never removed from the filter, so a cached word
+    can never become stale.
+
+    Hits and misses are counted with the label `metric_label` (the kind
+    of filter), or not at all if it is None.
+    """
+    def __init__(self, size, metric_label='disk'):
+        self.size = size
+        self._words = collections.OrderedDict()
+
+        self._hits = None
+        self._misses = None
+        if metric_label is not None:
+            self._hits = DEDUPLICATION_CACHE_HITS.labels(filter=metric_label)
+            self._misses = DEDUPLICATION_CACHE_MISSES.labels(
+                filter=metric_label)
+
+    def lookup(self, word):
+        if word in self._words:
+            self._words.move_to_end(word)
+            if self._hits is not None:
+                self._hits.inc()
+            return True
+
+        if self._misses is not None:
+            self._misses.inc()
+        return False
+
+    def add(self, word):
+        self._words[word] = None
+        self._words.move_to_end(word)
+
+        if len(self._words) > self.size:
+            self._words.popitem(last=False)
+
+
+def detect_bucket_formats(trie_directory):
+    """Return the set of bucket formats that have files in the given
+    directory."""
+    formats = set()
+    for filename in os.listdir(trie_directory):
+        for bucket_format, bucket_class in BUCKET_FORMATS.items():
+            if bucket_class.owns_file(filename):
+                formats.add(bucket_format)
+
+    return formats
+
+
+class DiskTrieDuplicatesFilter(object):
+    """Duplicates filter that stores words in 256 bucket files, the bucket
+    of a word is determined by the first byte of its SHA-256 digest.
+
+    If `locking` is enabled, all access to a bucket is guarded by a
+    `fcntl` lock on one byte of a shared lock file, so that several
+    processes (e.g. spiders running in parallel) can use the same filter
+    directory. All processes must use the same format and bloom filter
+    parameters then.
+    """
+    BLOOM_FILENAME = 'bloom'
+    LOCK_FILENAME = 'lock'
+    GENERATION_FILENAME = 'generation'
+
+    # byte in the lock file that guards the bloom filter and the
+    # generation counter, the bytes 0 to 255 are used for the buckets
+    BLOOM_LOCK_INDEX = 256
+
+    def __init__(self, trie_directory, bucket_format='text',
+                 bloom_capacity=None, bloom_error_rate=0.01, locking=False,
+                 cache_size=0, check_format=True):
+        if bucket_format not in BUCKET_FORMATS:
+            raise ValueError(
+                'Unknown bucket format "{}"'.format(bucket_format))
+
+        # buckets of another format would be ignored silently, which
+        # lets all their IDs pass as new
+        if check_format:
+            other_formats = detect_bucket_formats(trie_directory) \
+                - {bucket_format}
+            if other_formats:
+                raise ValueError(
+                    '{} contains buckets in format {}, convert them to "{}" '
+                    'first'.format(trie_directory,
+                                   ', '.join(sorted(other_formats)),
+                                   bucket_format))
+
+        self.trie_directory = trie_directory
+        self.bucket_format = bucket_format
+        self._buckets = {}
+
+        # recently seen words are answered without any disk access
+        self._cache = RecentWordsCache(cache_size) if cache_size else None
+
+        self._lock_file = None
+        if locking:
+            self._lock_file = open(
+                os.path.join(trie_directory, self.LOCK_FILENAME), 'a+')
+
+        self._generation = _GenerationCounter(
+            os.path.join(trie_directory, self.GENERATION_FILENAME))
+
+        # The bloom filter answers most lookups for new words without
+        # touching the buckets at all
+        self._bloom = None
+        self._bloom_capacity = bloom_capacity
+        if bloom_capacity:
+            with self._locked(self.BLOOM_LOCK_INDEX, exclusive=True):
+                self._bloom = self._open_bloom(
+                    bloom_capacity, bloom_error_rate)
+
+    def add_word(self, word):
+        self.add_words([word])
+
+    def has_word(self, word):
+        if self._cache is not None and self._cache.lookup(word):
+            return True
+
+        digest = self._digest(word)
+
+        if self._bloom is not None and not self._bloom.might_contain(digest):
+            return False
+
+        name = self._bucket_name(digest)
+        with self._locked(int(name, 16), exclusive=False):
+            found = self._bucket_by_name(name).contains(digest, word)
+
+        if found:
+            self._remember(word)
+        return found
+
+    def add_word_if_new(self, word):
+        """Add the word if it is not stored yet and return whether it was
+        new. With locking enabled, check and insert are atomic.
+        """
+        return word in self.add_words_if_new([word])
+
+    def add_words(self, words):
+        """Add several words at once. Each affected bucket is only opened
+        once per call.
+        """
+        for name, bucket_words in self._group_by_bucket(words).items():
+            with self._locked(int(name, 16), exclusive=True):
+                self._add_to_bucket(name, bucket_words)
+
+            for _, word in bucket_words:
+                self._remember(word)
+
+    def add_words_if_new(self, words):
+        """Add all words that are not stored yet and return the set of
+        words that were new. Each affected bucket is locked, checked and
+        updated once per call.
+        """
+        words = self._uncached(words)
+
+        new_words = set()
+        for name, bucket_words in self._group_by_bucket(words).items():
+            with self._locked(int(name, 16), exclusive=True):
+                found = self._find_in_bucket(name, bucket_words)
+
+                added = []
+                for digest, word in bucket_words:
+                    if word not in found and word not in new_words:
+                        new_words.add(word)
+                        added.append((digest, word))
+
+                self._add_to_bucket(name, added)
+
+            for _, word in bucket_words:
+                self._remember(word)
+
+        return new_words
+
+    def has_words(self, words):
+        """Check several words at once and return the set of words that
+        are already stored in the filter. Each affected bucket is only
+        opened and scanned once per call.
+        """
+        found = set()
+        uncached = self._uncached(words, found)
+        for name, bucket_words in self._group_by_bucket(uncached).items():
+            with self._locked(int(name, 16), exclusive=False):
+                found_in_bucket = self._find_in_bucket(name, bucket_words)
+
+            for word in found_in_bucket:
+                self._remember(word)
+            found.update(found_in_bucket)
+
+        return found
+
+    def compact(self):
+        """Compact all buckets of this filter, e.g. before a backup."""
+        for i, bucket in enumerate(self._all_buckets()):
+            with self._locked(i, exclusive=True):
+                bucket.compact()
+
+    def convert_to(self, bucket_format):
+        """Convert all buckets to another bucket format and return a
+        filter for the converted buckets. Buckets are converted one after
+        another, each one is written completely before the old files are
+        removed.
+        """
+        if bucket_format == self.bucket_format:
+            self.compact()
+            return self
+
+        if self.bucket_format == 'digest':
+            raise ValueError('Buckets in digest format only contain hashes '
+                             'and cannot be converted to other formats')
+
+        target = DiskTrieDuplicatesFilter(
+            self.trie_directory, bucket_format, check_format=False)
+        for i in range(256):
+            name = '{:02x}'.format(i)
+            source_bucket = self._bucket_by_name(name)
+
+            with self._locked(i, exclusive=True):
+                entries = [(_digest(word), word)
+                           for word in source_bucket.words()]
+                if entries:
+                    target._bucket_by_name(name).rebuild(entries)
+                source_bucket.remove()
+
+        self.close()
+        return target
+
+    def close(self):
+        for bucket in self._buckets.values():
+            bucket.close()
+
+        if self._bloom is not None:
+            # make all bits durable before we stop counting as an open
+            # user of the filter
+            self._bloom.flush()
+            with self._locked(self.BLOOM_LOCK_INDEX, exclusive=True):
+                self._bloom.open_count = max(0, self._bloom.open_count - 1)
+                self._bloom.close()
+            self._bloom = None
+
+        self._generation.close()
+
+        if self._lock_file is not None:
+            self._lock_file.close()
+
+    def _uncached(self, words, cached=None):
+        """Return the words that are not in the cache. Cached words are
+        added to `cached` if it is given."""
+        if self._cache is None:
+            return words
+
+        uncached = []
+        for word in words:
+            if not self._cache.lookup(word):
+                uncached.append(word)
+            elif cached is not None:
+                cached.add(word)
+
+        return uncached
+
+    def _remember(self, word):
+        if self._cache is not None:
+            self._cache.add(word)
+
+    @contextlib.contextmanager
+    def _locked(self, index, exclusive):
+        if self._lock_file is None:
+            yield
+            return
+
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        fcntl.lockf(self._lock_file, operation, 1, index)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._lock_file, fcntl.LOCK_UN, 1, index)
+
+    def _find_in_bucket(self, name, bucket_words):
+        if self._bloom is not None:
+            bucket_words = [(digest, word) for digest, word in bucket_words
+                            if self._bloom.might_contain(digest)]
+        if not bucket_words:
+            return set()
+
+        return self._bucket_by_name(name).contains_many(bucket_words)
+
+    def _add_to_bucket(self, name, bucket_words):
+        if not bucket_words:
+            return
+
+        # add to the bloom filter first: if we crash in between we only
+        # get a false positive, but never miss a stored word
+        with self._locked(self.BLOOM_LOCK_INDEX, exclusive=True):
+            if self._bloom is None:
+                self._generation.increment()
+            else:
+                self._add_to_bloom(bucket_words)
+
+        self._bucket_by_name(name).add_many(bucket_words)
+
+    def _add_to_bloom(self, bucket_words):
+        # the bloom filter only stays in sync, if it was in sync before,
+        # i.e. nobody wrote to the buckets without updating the filter
+        in_sync = self._bloom.generation == self._generation.value
+        generation = self._generation.increment()
+
+        for digest, _ in bucket_words:
+            self._bloom.add(digest)
+
+        if in_sync:
+            self._bloom.generation = generation
+
+        count = self._bloom.count
+        self._bloom.count = count + len(bucket_words)
+        if count <= self._bloom_capacity < count + len(bucket_words):
+            logging.warning(
+                'Bloom filter in {} holds more than its capacity of {} '
+                'entries, its false positive rate will increase'.format(
+                    self.trie_directory, self._bloom_capacity))
+
+    def _open_bloom(self, capacity, error_rate):
+        path = os.path.join(self.trie_directory, self.BLOOM_FILENAME)
+        num_bits, num_hashes = BloomFilter.optimal_parameters(
+            capacity, error_rate)
+
+        bloom = None
+        try:
+            bloom = BloomFilter(path)
+            if (bloom.num_bits, bloom.num_hashes) != (num_bits, num_hashes):
+                # configuration changed, the filter has to be recreated
+                bloom.close()
+                bloom = None
+        except (FileNotFoundError, ValueError):
+            pass
+
+        if bloom is None:
+            bloom = BloomFilter.create(path, num_bits, num_hashes)
+            bloom.generation = self._generation.value + 1
+
+        boot_id = _boot_id()
+        rebooted = bloom.boot_id != boot_id
+        # after a reboot, bits might be lost if a process did not close
+        # the filter properly (i.e. it has not been synced to disk)
+        crashed = rebooted and bloom.open_count > 0
+        if bloom.generation != self._generation.value or crashed:
+            logging.info('Rebuilding bloom filter in {}'.format(
+                self.trie_directory))
+
+            # bits are only added, never cleared, so other processes can
+            # keep using the filter while it is rebuilt
+            count = 0
+            for digest in self._all_digests():
+                bloom.add(digest)
+                count += 1
+
+            bloom.count = count
+            bloom.generation = self._generation.value
+
+        if rebooted:
+            bloom.boot_id = boot_id
+            bloom.open_count = 0
+        bloom.open_count += 1
+        bloom.flush()
+
+        if bloom.count > capacity:
+            logging.warning(
+                'Bloom filter in {} holds {} entries, but has a capacity of '
+                '{} entries only'.format(
+                    self.trie_directory, bloom.count, capacity))
+
+        return bloom
+
+    def _all_digests(self):
+        for bucket in self._all_buckets():
+            for digest in bucket.digests():
+                yield digest
+
+    def _group_by_bucket(self, words):
+        groups = collections.defaultdict(list)
+        for word in words:
+            digest = self._digest(word)
+            groups[self._bucket_name(digest)].append((digest, word))
+
+        return groups
+
+    def _bucket_name(self, digest):
+        # use the first byte of the hash. This should produce a quite
         # good distribution for our 2.5 GB (see above)
-        h = hashlib.sha256(word.encode('utf-8'))
-        digest = h.hexdigest()
-        return digest[0:2]
+        return digest[0:1].hex()
+
+    def _bucket_by_name(self, name):
+        try:
+            return self._buckets[name]
+        except KeyError:
+            bucket_class = BUCKET_FORMATS[self.bucket_format]
+            bucket = bucket_class(os.path.join(self.trie_directory, name))
+            self._buckets[name] = bucket
+            return bucket
+
+    def _all_buckets(self):
+        for i in range(256):
+            yield self._bucket_by_name('{:02x}'.format(i))
+
+    def _digest(self, word):
+        return _digest(word)
+
+
+class ExpiringDuplicatesFilter(object):
+    """Duplicates filter that forgets words `ttl` seconds after they were
+    added.
+
+    Words are stored in generations, each generation is a
+    `DiskTrieDuplicatesFilter` in a subdirectory named after the time it
+    was started. A new generation is started every `ttl / GENERATIONS`
+    seconds, so the insertion time of each word is known with this
+    precision and a word expires at most one generation too late.
+    Lookups check all generations that are not expired yet, new words
+    are only added to the newest one. Expired generations are removed
+    by `expire_generations`.
+
+    All other arguments are passed on to the filter of each generation.
+    """
+    GENERATIONS = 8
+    METADATA_FILENAME = 'ttl.json'
+
+    def __init__(self, directory, ttl, bucket_format='text',
+                 **filter_options):
+        if ttl <= 0:
+            raise ValueError('The TTL must be positive')
+
+        self.directory = directory
+        self.ttl = ttl
+        self.generation_length = ttl / self.GENERATIONS
+        self.bucket_format = bucket_format
+        self.filter_options = filter_options
+        self._filters = {}
+
+        os.makedirs(directory, exist_ok=True)
+        # the expiry job must know the TTL without any spider settings
+        _write_ttl_metadata(directory, ttl)
+
+    def add_word(self, word):
+        self.add_words([word])
+
+    def has_word(self, word):
+        return word in self.has_words([word])
+
+    def add_word_if_new(self, word):
+        return word in self.add_words_if_new([word])
+
+    def add_words(self, words):
+        self._current_filter().add_words(words)
+
+    def add_words_if_new(self, words):
+        """Add all words that are not stored in any live generation and
+        return the set of words that were new.
+        """
+        words = list(words)
+        current = self._current_filter()
+        found = set()
+        for trie_filter in self._live_filters():
+            if trie_filter is not current:
+                found.update(trie_filter.has_words(words))
+
+        # older generations never receive new words, so the check and
+        # insert of the newest generation is enough to stay atomic
+        return current.add_words_if_new(
+            word for word in words if word not in found)
+
+    def has_words(self, words):
+        words = list(words)
+        found = set()
+        for trie_filter in self._live_filters():
+            found.update(trie_filter.has_words(
+                word for word in words if word not in found))
+
+        return found
+
+    def compact(self):
+        for trie_filter in self._live_filters():
+            trie_filter.compact()
+
+    def close(self):
+        for trie_filter in self._filters.values():
+            trie_filter.close()
+        self._filters = {}
+
+    def _live_filters(self, now=None):
+        live = _live_generations(self.directory, self.ttl, now)
+
+        # drop filters (and their cached words) of expired generations
+        for start in list(self._filters):
+            if start not in live:
+                self._filters.pop(start).close()
+
+        return [self._filter(start) for start in live]
+
+    def _current_filter(self, now=None):
+        now = time.time() if now is None else now
+
+        generations = _generations(self.directory)
+        if generations and now < generations[-1] + self.generation_length:
+            start = generations[-1]
+        else:
+            # processes starting a generation at the same time agree on
+            # the name of its directory
+            start = int(now // self.generation_length
+                        * self.generation_length)
+            if generations and start <= generations[-1]:
+                # the generation length changed with the TTL
+                start = int(now)
+            os.makedirs(os.path.join(self.directory, str(start)),
+                        exist_ok=True)
+
+        return self._filter(start)
+
+    def _filter(self, start):
+        try:
+            return self._filters[start]
+        except KeyError:
+            trie_filter = DiskTrieDuplicatesFilter(
+                os.path.join(self.directory, str(start)),
+                self.bucket_format, **self.filter_options)
+            self._filters[start] = trie_filter
+            return trie_filter
+
+
+def _write_ttl_metadata(directory, ttl):
+    path = os.path.join(directory, ExpiringDuplicatesFilter.METADATA_FILENAME)
+    tmp_path = '{}.{}'.format(path, uuid.uuid4().hex)
+    with open(tmp_path, 'w') as f:
+        json.dump({'ttl': ttl}, f)
+    os.rename(tmp_path, path)
+
+
+def _generations(directory):
+    """Return the start times of all generations, oldest first."""
+    return sorted(int(name) for name in os.listdir(directory)
+                  if name.isdigit()
+                  and os.path.isdir(os.path.join(directory, name)))
+
+
+def _live_generations(directory, ttl, now=None):
+    """Return the start times of all generations that still contain
+    words younger than `ttl` seconds.
+    """
+    now = time.time() if now is None else now
+
+    generations = _generations(directory)
+    live = []
+    for i, start in enumerate(generations):
+        # a generation receives words until the next one is started, but
+        # never longer than the generation length
+        end = start + ttl / ExpiringDuplicatesFilter.GENERATIONS
+        if i + 1 < len(generations):
+            end = min(end, generations[i + 1])
+        if end > now - ttl:
+            live.append(start)
+
+    return live
+
+
+def expire_generations(directory, now=None):
+    """Remove all expired generations of an `ExpiringDuplicatesFilter`
+    and return their number.
+    """
+    path = os.path.join(directory, ExpiringDuplicatesFilter.METADATA_FILENAME)
+    with open(path) as f:
+        ttl = json.load(f)['ttl']
+
+    live = _live_generations(directory, ttl, now)
+    expired = [start for start in _generations(directory)
+               if start not in live]
+    for start in expired:
+        shutil.rmtree(os.path.join(directory, str(start)))
+
+    return len(expired)
+
+
+def expire_all_generations(root_directory, now=None):
+    """Remove expired generations of all expiring filters below
+    `root_directory` and return their number.
+    """
+    expired = 0
+    for directory, _, filenames in os.walk(root_directory):
+        if ExpiringDuplicatesFilter.METADATA_FILENAME in filenames:
+            expired += expire_generations(directory, now)
+
+    return expired
@@ -1,4 +1,7 @@
 import os
+import json
+import time
+import tempfile
 import subprocess
 import datetime
 import heapq
@@ -12,6 +15,9 @@ from scrapy.exceptions import DropItem
 from scrapy.crawler import CrawlerProcess
 from scrapy.utils.project import get_project_settings
 
+import skyscraper.instrumentation
+from skyscraper.instrumentation import PipelineStageInstrumentation
+
 
 SPIDERS_EXECUTED_COUNT = prometheus_client.Counter(
     'skyscraper_executed_spiders',
@@ -92,11 +98,58 @@ class ScrapySpiderRunner(object):
     """This class is a runner to help with the execution of spiders with
     a given configuration. It sets up the environment and configurations
     and then executes the spider.
+
+    `run_standalone` records duration, exit code, resource usage and
+    crawl statistics of each run as metrics and, if `run_history` is
+    given, in the run history.
     """
-    def __init__(self, http_proxy):
+    def __init__(self, http_proxy, run_history=None):
         self.http_proxy = http_proxy
+        self.run_history = run_history
 
     def run_standalone(self, namespace, spider, options={}):
+        command = self._command(namespace, spider, options)
+
+        # the subprocess writes the stats of its crawl to this file
+        fd, stats_path = tempfile.mkstemp(prefix='skyscraper-stats-')
+        os.close(fd)
+        env = dict(os.environ, SKYSCRAPER_RUN_STATS_FILE=stats_path)
+
+        try:
+            start = time.monotonic()
+            started_at = datetime.datetime.utcnow()
+            process = subprocess.Popen(command, env=env)
+            _, status, rusage = os.wait4(process.pid, 0)
+            # the process is reaped already, Popen must not wait for it
+            process.returncode = _exit_code(status)
+            duration = time.monotonic() - start
+
+            stats = _read_stats(stats_path)
+        finally:
+            os.remove(stats_path)
+
+        run = {
+            'namespace': namespace,
+            'spider': spider,
+            'start_time': started_at.isoformat(),
+            'duration': duration,
+            'exit_code': process.returncode,
+            # kilobytes on Linux
+            'max_rss': rusage.ru_maxrss * 1024,
+            'cpu_time': rusage.ru_utime + rusage.ru_stime,
+            'items': stats.get('item_scraped_count', 0)
+            if stats is not None else None,
+            'requests': stats.get('downloader/request_count', 0)
+            if stats is not None else None,
+        }
+
+        skyscraper.instrumentation.record_spider_run(run)
+        if self.run_history is not None:
+            self.run_history.append(run)
+
+        return run
+
+    def _command(self, namespace, spider, options):
         command = [
             'skyscraper-spider',
             namespace,
@@ -106,7 +159,7 @@ class ScrapySpiderRunner(object):
         if 'tor' in options and options['tor']:
             command.append('--use-tor')
 
-        subprocess.call(command)
+        return command
 
     def run(self, namespace, spider, semaphore=None, options={}):
         """Run the given spider with the defined options. Will block
@@ -122,9 +175,14 @@ class ScrapySpiderRunner(object):
         settings = get_project_settings()
         settings['USER_NAMESPACE'] = namespace
         process = CrawlerProcess(settings)
-        process.crawl(spider)
+        crawler = process.create_crawler(spider)
+        process.crawl(crawler)
         process.start()
 
+        if os.environ.get('SKYSCRAPER_RUN_STATS_FILE'):
+            with open(os.environ.get('SKYSCRAPER_RUN_STATS_FILE'), 'w') as f:
+                json.dump(crawler.stats.get_stats(), f, default=str)
+
         self._release_run_lock(semaphore)
 
     def _set_proxy_tor(self):
@@ -153,6 +211,26 @@ class ScrapySpiderRunner(object):
             semaphore.release()
 
 
+def _exit_code(status):
+    """Return the exit code of a wait status like `subprocess` does, i.e.
+    `-signal` if the process was killed by a signal.
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _read_stats(path):
+    """Return the Scrapy stats written by a spider subprocess or None if
+    it did not write any (e.g. because it crashed).
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
 class ChromeCrawler(object):
     def __init__(self, settings, browser_future):
         # TODO: Improve the async stuff, we actually only need sync
@@ -204,13 +282,24 @@ class ChromeSpiderRunner(object):
         spider = spider_class()
 
         pipelines = [self._load_pipeline(p, self.crawler) for p in self.pipelines]
+        for pipeline in pipelines:
+            if hasattr(pipeline, 'open_spider'):
+                pipeline.open_spider(spider)
+
+        stages = [PipelineStageInstrumentation(p.process_item, p, project)
+                  for p in pipelines]
+
         async for item in self.crawler.crawl(spider):
-            for pipeline in pipelines:
+            for process_item in stages:
                 try:
-                    item = pipeline.process_item(item, spider)
+                    item = process_item(item, spider)
                 except DropItem:
                     # do not further process the item
-                    pass
+                    break
+
+        for pipeline in pipelines:
+            if hasattr(pipeline, 'close_spider'):
+                pipeline.close_spider(spider)
 
     async def close(self):
         await self.crawler.close()
@@ -1,5 +1,11 @@
 import os
+import json
+import time
 import prometheus_client
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+from scrapy.exceptions import DropItem
+from scrapy.pipelines import ItemPipelineManager
 
 import skyscraper.settings
 
@@ -9,19 +15,295 @@ NUMBER_OF_FILES = prometheus_client.Gauge(
     'Number of files stored in Skyscraper',
     ['project', 'spider'])
 
+PIPELINE_LATENCY = prometheus_client.Histogram(
+    'skyscraper_pipeline_process_item_seconds',
+    'Time spent in process_item of a pipeline step',
+    ['pipeline', 'namespace', 'spider'])
+PIPELINE_ITEMS = prometheus_client.Counter(
+    'skyscraper_pipeline_items',
+    'Items that entered a pipeline step',
+    ['pipeline', 'namespace', 'spider'])
+PIPELINE_DROPPED_ITEMS = prometheus_client.Counter(
+    'skyscraper_pipeline_dropped_items',
+    'Items dropped by a pipeline step',
+    ['pipeline', 'namespace', 'spider'])
+PIPELINE_ERRORS = prometheus_client.Counter(
+    'skyscraper_pipeline_errors',
+    'Items for which a pipeline step raised an error',
+    ['pipeline', 'namespace', 'spider'])
+SPIDER_RUN_DURATION = prometheus_client.Histogram(
+    'skyscraper_spider_run_duration_seconds',
+    'Wall-clock duration of spider runs',
+    ['namespace', 'spider'],
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200,
+             float('inf')))
+SPIDER_RUN_CPU = prometheus_client.Histogram(
+    'skyscraper_spider_run_cpu_seconds',
+    'CPU time (user and system) of spider runs',
+    ['namespace', 'spider'],
+    buckets=(0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600,
+             float('inf')))
+SPIDER_RUN_MAX_RSS = prometheus_client.Gauge(
+    'skyscraper_spider_run_max_rss_bytes',
+    'Peak resident memory of the last run of a spider',
+    ['namespace', 'spider'], multiprocess_mode='mostrecent')
+SPIDER_RUN_EXIT_CODE = prometheus_client.Gauge(
+    'skyscraper_spider_run_exit_code',
+    'Exit code of the last run of a spider',
+    ['namespace', 'spider'], multiprocess_mode='mostrecent')
+SPIDER_RUN_ITEMS = prometheus_client.Gauge(
+    'skyscraper_spider_run_items',
+    'Items scraped in the last run of a spider',
+    ['namespace', 'spider'], multiprocess_mode='mostrecent')
+SPIDER_RUN_REQUESTS = prometheus_client.Gauge(
+    'skyscraper_spider_run_requests',
+    'Requests made in the last run of a spider',
+    ['namespace', 'spider'], multiprocess_mode='mostrecent')
+SERIALIZED_BYTES = prometheus_client.Counter(
+    'skyscraper_serialized_bytes',
+    'Bytes of serialized items',
+    ['namespace', 'spider', 'codec'])
+
+
+# hidden file in each storage folder to which writers append the number
+# of files they added or removed, one signed integer per line
+FILE_COUNT_JOURNAL = '.num-files'
+
+
+def count_files(directory, delta=1):
+    """Record that `delta` files were added to (or removed from, if
+    negative) a storage folder. Appends are atomic, so any number of
+    processes can record changes at the same time.
+    """
+    fd = os.open(os.path.join(directory, FILE_COUNT_JOURNAL),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, '{}\n'.format(delta).encode('ascii'))
+    finally:
+        os.close(fd)
+
+
+class FileCountTracker(object):
+    """Keeps the number of files per spider folder up to date without
+    listing the folders.
+
+    Each folder is listed once, afterwards its count is updated with the
+    changes that writers recorded with `count_files`. Every
+    `reconcile_interval` seconds, folders whose modification time changed
+    since they were last listed are listed again, which also catches
+    changes that were not recorded. Changes recorded while a folder is
+    listed are counted twice until the next reconciliation.
+    """
+    def __init__(self, directory, reconcile_interval=3600):
+        self.directory = directory
+        self.reconcile_interval = reconcile_interval
+
+        # spider folder -> [count, journal offset, mtime_ns when listed]
+        self._folders = {}
+        self._last_reconcile = time.monotonic()
+
+    def update(self):
+        now = time.monotonic()
+        reconcile = now - self._last_reconcile >= self.reconcile_interval
+        if reconcile:
+            self._last_reconcile = now
+
+        seen = set()
+        for project, spider, path in self._spider_folders():
+            seen.add(path)
+
+            state = self._folders.get(path)
+            if state is None or (reconcile and
+                                 os.stat(path).st_mtime_ns != state[2]):
+                state = self._folders[path] = self._list(path)
+            else:
+                self._apply_journal(path, state)
+
+            NUMBER_OF_FILES.labels(project=project, spider=spider) \
+                .set(state[0])
+
+        for path in set(self._folders) - seen:
+            del self._folders[path]
+
+    def _list(self, path):
+        # the listing replaces all recorded changes
+        journal = os.path.join(path, FILE_COUNT_JOURNAL)
+        try:
+            os.remove(journal)
+        except FileNotFoundError:
+            pass
+
+        mtime_ns = os.stat(path).st_mtime_ns
+        with os.scandir(path) as entries:
+            # hidden files are segments that are still being written and
+            # bookkeeping like the journal or the archive manifest
+            count = sum(1 for entry in entries
+                        if not entry.name.startswith('.')
+                        and entry.is_file())
+
+        return [count, 0, mtime_ns]
+
+    def _apply_journal(self, path, state):
+        try:
+            with open(os.path.join(path, FILE_COUNT_JOURNAL), 'rb') as f:
+                if os.fstat(f.fileno()).st_size < state[1]:
+                    # the journal was replaced by a new one
+                    state[1] = 0
+                f.seek(state[1])
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        # a writer might not have finished its last line yet
+        complete = data[:data.rfind(b'\n') + 1]
+        state[0] += sum(int(line) for line in complete.split())
+        state[1] += len(complete)
+
+    def _spider_folders(self):
+        with os.scandir(self.directory) as projects:
+            for project in projects:
+                if not project.is_dir():
+                    continue
+
+                with os.scandir(project.path) as spiders:
+                    for spider in spiders:
+                        if spider.is_dir():
+                            yield project.name, spider.name, spider.path
+
+
+def record_spider_run(run):
+    """Export the metrics of a finished spider run, a dictionary as
+    created by `ScrapySpiderRunner.run_standalone`.
+    """
+    labels = {'namespace': run['namespace'], 'spider': run['spider']}
+
+    SPIDER_RUN_DURATION.labels(**labels).observe(run['duration'])
+    SPIDER_RUN_CPU.labels(**labels).observe(run['cpu_time'])
+    SPIDER_RUN_MAX_RSS.labels(**labels).set(run['max_rss'])
+    SPIDER_RUN_EXIT_CODE.labels(**labels).set(run['exit_code'])
+    if run.get('items') is not None:
+        SPIDER_RUN_ITEMS.labels(**labels).set(run['items'])
+    if run.get('requests') is not None:
+        SPIDER_RUN_REQUESTS.labels(**labels).set(run['requests'])
+
+
+class RunHistory(object):
+    """Keeps the last `max_runs` spider runs in a JSON lines file.
+
+    Runs are appended; once the file holds twice as many runs as it
+    should, it is rewritten with the most recent ones.
+    """
+    def __init__(self, path, max_runs=1000):
+        self.path = path
+        self.max_runs = max_runs
+        self._num_runs = None
+
+    def append(self, run):
+        if self._num_runs is None:
+            self._num_runs = len(self.runs())
+
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(run) + '\n')
+        self._num_runs += 1
+
+        if self._num_runs >= 2 * self.max_runs:
+            self._truncate()
+
+    def runs(self):
+        """Return the recorded runs, oldest first."""
+        try:
+            with open(self.path) as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def _truncate(self):
+        runs = self.runs()[-self.max_runs:]
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for run in runs:
+                f.write(json.dumps(run) + '\n')
+        os.rename(tmp_path, self.path)
+        self._num_runs = len(runs)
+
+
+_tracker = None
+
 
 def instrument_num_files():
+    global _tracker
+
     directory = skyscraper.settings.SKYSCRAPER_STORAGE_FOLDER_PATH
+    if _tracker is None or _tracker.directory != directory:
+        _tracker = FileCountTracker(
+            directory,
+            getattr(skyscraper.settings,
+                    'SKYSCRAPER_NUM_FILES_RECONCILE_INTERVAL', 3600))
+
+    _tracker.update()
+
+
+class PipelineStageInstrumentation(object):
+    """Wraps `process_item` of a pipeline step and records its latency and
+    how many items entered it, were dropped or caused an error.
+
+    `process_item` may also return a Deferred (Scrapy), then the time
+    until it fired is recorded.
+    """
+    def __init__(self, process_item, pipeline, namespace=None):
+        self.process_item = process_item
+        self.pipeline = '{}.{}'.format(
+            type(pipeline).__module__, type(pipeline).__name__)
+        self.namespace = namespace
+
+    def __call__(self, item, spider):
+        labels = {
+            'pipeline': self.pipeline,
+            'namespace': self.namespace or '',
+            'spider': spider.name or '',
+        }
+        PIPELINE_ITEMS.labels(**labels).inc()
+
+        start = time.perf_counter()
+        try:
+            result = self.process_item(item, spider)
+        except Exception as e:
+            self._observe(labels, start, e)
+            raise
+
+        if isinstance(result, Deferred):
+            result.addBoth(self._observe_deferred, labels, start)
+        else:
+            self._observe(labels, start)
+        return result
+
+    def _observe_deferred(self, result, labels, start):
+        error = result.value if isinstance(result, Failure) else None
+        self._observe(labels, start, error)
+        return result
+
+    def _observe(self, labels, start, error=None):
+        PIPELINE_LATENCY.labels(**labels).observe(time.perf_counter() - start)
+        if isinstance(error, DropItem):
+            PIPELINE_DROPPED_ITEMS.labels(**labels).inc()
+        elif error is not None:
+            PIPELINE_ERRORS.labels(**labels).inc()
 
-    for project in os.listdir(directory):
-        project_dir = os.path.join(directory, project)
 
-        if os.path.isdir(project_dir):
-            for spider in os.listdir(project_dir):
-                spider_dir = os.path.join(project_dir, spider)
+class InstrumentedItemPipelineManager(ItemPipelineManager):
+    """Item pipeline manager for Scrapy (setting `ITEM_PROCESSOR`) that
+    instruments every pipeline step with `PipelineStageInstrumentation`.
+    """
+    @classmethod
+    def from_crawler(cls, crawler):
+        manager = super().from_crawler(crawler)
+        for stage in manager.methods['process_item']:
+            stage.namespace = crawler.settings.get('USER_NAMESPACE')
+        return manager
 
-                if os.path.isdir(spider_dir):
-                    num_files = len([name for name in os.listdir(spider_dir)
-                                     if os.path.isfile(os.path.join(spider_dir, name))])
-                    NUMBER_OF_FILES.labels(project=project, spider=spider) \
-                        .set(num_files)
+    def _add_middleware(self, pipe):
+        super()._add_middleware(pipe)
+        if hasattr(pipe, 'process_item'):
+            stages = self.methods['process_item']
+            stages[-1] = PipelineStageInstrumentation(stages[-1], pipe)
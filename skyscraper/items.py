@@ -16,6 +16,8 @@ class BasicItem(scrapy.Item):
     url = scrapy.Field()
     slug = scrapy.Field()  # deprecated
     source = scrapy.Field()
+    # reference into a blob store if the source is stored there
+    source_ref = scrapy.Field()
     data = scrapy.Field()
     downloads = scrapy.Field()
 
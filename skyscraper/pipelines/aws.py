@@ -1,14 +1,39 @@
 # -*- coding: utf-8 -*-
 
-import boto3
+import boto3.s3.transfer
 from boto3.dynamodb.conditions import Key, Attr
 from botocore.exceptions import ClientError
-import json
+import io
+import time
+import logging
+import threading
+import concurrent.futures
 import datetime
 import collections
 
-from scrapy.exporters import PythonItemExporter
 from scrapy.exceptions import DropItem
+from scrapy.crawler import Crawler
+
+import skyscraper.aws
+import skyscraper.compression
+import skyscraper.serialization
+from skyscraper.batching import Batch, DuplicatesBatch
+from skyscraper.deduplication import RecentWordsCache
+
+
+# IDs that this process passed on or stored recently, per index and
+# namespace. They might not be in the index yet, because they are still
+# buffered by StoreItemToDuplicateFilterPipeline or the item has not
+# reached it yet.
+LOCAL_IDS_SIZE = 100000
+_local_ids = {}
+
+
+def _recent_local_ids(dynamodb_index, namespace):
+    key = (dynamodb_index.name, namespace)
+    if key not in _local_ids:
+        _local_ids[key] = RecentWordsCache(LOCAL_IDS_SIZE, metric_label=None)
+    return _local_ids[key]
 
 
 class DoNotStoreDuplicatesPipeline(object):
@@ -19,88 +44,239 @@ class DoNotStoreDuplicatesPipeline(object):
 
     If an item has already been scraped before it will be dropped and not
     passed further to other pipeline steps.
+
+    If `batch_size` is larger than one, items are collected and checked
+    with one `BatchGetItem` request, once either `batch_size` items are
+    pending or `batch_window` seconds have passed. In this mode
+    `process_item` returns a Deferred, so it is only enabled for the
+    scrapy engine. IDs that were found in the index are kept in a cache
+    of `cache_size` entries and are dropped without a request.
+
+    IDs that passed this step or are buffered by
+    StoreItemToDuplicateFilterPipeline in the same process are dropped
+    as well, even if they are not in the index yet.
     """
-    def __init__(self, dynamodb_index, namespace):
+    # limit of DynamoDB for one BatchGetItem request
+    MAX_BATCH_SIZE = 100
+    MAX_RETRIES = 5
+
+    def __init__(self, dynamodb_index, namespace, batch_size=1,
+                 batch_window=1.0, cache_size=0):
         self.namespace = namespace
         self.article_index = dynamodb_index
 
+        self.batch_size = min(batch_size, self.MAX_BATCH_SIZE)
+        self.batch_window = batch_window
+        self._batch = DuplicatesBatch(
+            self._find_new_ids, self.batch_size, batch_window)
+
+        self._cache = RecentWordsCache(cache_size, metric_label='dynamodb') \
+            if cache_size else None
+        self._local_ids = _recent_local_ids(dynamodb_index, namespace)
+
     @classmethod
     def from_crawler(cls, crawler):
         settings = crawler.settings
 
-        session = boto3.Session(
-            aws_access_key_id=settings.get('AWS_ACCESS_KEY'),
-            aws_secret_access_key=settings.get('AWS_SECRET_ACCESS_KEY'),
-            region_name='us-east-1'
-        )
-        dynamodb = session.resource('dynamodb')
+        dynamodb = skyscraper.aws.get_resource('dynamodb', settings)
         dynamodb_index = dynamodb.Table(settings.get('DYNAMODB_CRAWLING_INDEX'))
 
         namespace = settings.get('USER_NAMESPACE')
-
-        return cls(dynamodb_index, namespace)
+        batch_size = settings.getint('DYNAMODB_DEDUPLICATION_BATCH_SIZE', 1)
+        batch_window = settings.getfloat(
+            'DYNAMODB_DEDUPLICATION_BATCH_WINDOW', 1.0)
+        cache_size = settings.getint(
+            'DYNAMODB_DEDUPLICATION_CACHE_SIZE', 10000)
+
+        # other engines (e.g. chrome) cannot handle Deferreds as results
+        # of a pipeline step, check each item on its own for them
+        if batch_size > 1 and not isinstance(crawler, Crawler):
+            logging.warning('DYNAMODB_DEDUPLICATION_BATCH_SIZE is only '
+                            'supported by the scrapy engine, ignoring it')
+            batch_size = 1
+
+        return cls(dynamodb_index, namespace, batch_size, batch_window,
+                   cache_size)
 
     def process_item(self, item, spider):
+        if self._local_ids.lookup(item['id']) or (
+                self._cache is not None and self._cache.lookup(item['id'])):
+            raise DropItem("URL '%s' with item ID '%s' has already been crawled" % (item['url'], item['id']))
+
+        if self.batch_size > 1:
+            return self._batch.add(item['id'], item)
+
         response = self.article_index.query(
                 KeyConditionExpression=Key('Namespace').eq(self.namespace) \
                         & Key('Id').eq(item['id']))
 
         if response['Count'] > 0:
+            self._remember(item['id'])
             raise DropItem("URL '%s' with item ID '%s' has already been crawled" % (item['url'], item['id']))
         else:
+            self._local_ids.add(item['id'])
             return item
 
+    def flush(self):
+        """Check all pending items with one BatchGetItem request and fire
+        their Deferreds.
+        """
+        self._batch.flush()
+
+    def close_spider(self, spider):
+        self.flush()
+
+    def _find_new_ids(self, ids):
+        # IDs of earlier batches might have been passed on in the meantime
+        ids = set(id_ for id_ in ids if not self._local_ids.lookup(id_))
+
+        found = self._batch_get_ids(ids)
+        for id_ in found:
+            self._remember(id_)
+
+        new_ids = ids - found
+        for id_ in new_ids:
+            self._local_ids.add(id_)
+        return new_ids
+
+    def _batch_get_ids(self, ids):
+        """Return the subset of `ids` that is stored in the index."""
+        table_name = self.article_index.name
+        request = {table_name: {
+            'Keys': [{'Namespace': self.namespace, 'Id': id_}
+                     for id_ in ids],
+            'ProjectionExpression': 'Id',
+        }}
+
+        found = set()
+        retries = 0
+        while request:
+            response = self.article_index.meta.client.batch_get_item(
+                RequestItems=request)
+            for row in response['Responses'].get(table_name, []):
+                found.add(row['Id'])
+
+            # DynamoDB returns keys it could not process (e.g. when the
+            # table is throttled), they have to be requested again
+            request = response.get('UnprocessedKeys')
+            if request:
+                retries += 1
+                if retries > self.MAX_RETRIES:
+                    raise IOError('DynamoDB did not process {} keys'.format(
+                        len(request[table_name]['Keys'])))
+                time.sleep(0.05 * 2 ** retries)
+
+        return found
+
+    def _remember(self, id_):
+        if self._cache is not None:
+            self._cache.add(id_)
+
 
 class StoreItemToDuplicateFilterPipeline(object):
     """This pipeline stores the IDs of scraped items to a persistent
     duplicate filter. It is used in combination with
     DoNotStoreDuplicatesPipeline, which later checks if a spider tries to
     emit an item that has been scraped before.
+
+    If `buffer_size` is larger than one, IDs are buffered and written with
+    `BatchWriteItem` requests of up to 25 items, once `buffer_size` items
+    are pending or the oldest pending item is older than `buffer_seconds`.
+    Until then, other processes do not see the buffered IDs, but
+    DoNotStoreDuplicatesPipeline in the same process does. For the scrapy
+    engine, a timer flushes the buffer after `buffer_seconds`, otherwise
+    this is only checked when an item arrives.
     """
-    def __init__(self, dynamodb_index, namespace):
+    # limit of DynamoDB for one BatchWriteItem request
+    MAX_BATCH_SIZE = 25
+    MAX_RETRIES = 5
+
+    def __init__(self, dynamodb_index, namespace, buffer_size=1,
+                 buffer_seconds=5.0, flush_timer=True):
         self.namespace = namespace
 
         self.article_index = dynamodb_index
 
+        self.buffer_size = buffer_size
+        self.buffer_seconds = buffer_seconds
+        self._buffer = Batch(self._write, buffer_size, buffer_seconds,
+                             flush_timer)
+        self._local_ids = _recent_local_ids(dynamodb_index, namespace)
+
     @classmethod
     def from_crawler(cls, crawler):
         settings = crawler.settings
 
-        session = boto3.Session(
-            aws_access_key_id=settings.get('AWS_ACCESS_KEY'),
-            aws_secret_access_key=settings.get('AWS_SECRET_ACCESS_KEY'),
-            region_name='us-east-1'
-        )
-
-        dynamodb = session.resource('dynamodb')
+        dynamodb = skyscraper.aws.get_resource('dynamodb', settings)
         dynamodb_index = dynamodb.Table(settings.get('DYNAMODB_CRAWLING_INDEX'))
 
         namespace = settings.get('USER_NAMESPACE')
+        buffer_size = settings.getint('DYNAMODB_WRITE_BUFFER_SIZE', 1)
+        buffer_seconds = settings.getfloat(
+            'DYNAMODB_WRITE_BUFFER_SECONDS', 5.0)
 
-        return cls(dynamodb_index, namespace)
+        # only the scrapy engine runs the twisted reactor
+        flush_timer = isinstance(crawler, Crawler)
+
+        return cls(dynamodb_index, namespace, buffer_size, buffer_seconds,
+                   flush_timer)
 
     def process_item(self, item, spider):
+        self._local_ids.add(item['id'])
+
         # Store the meta info in our DynamoDB index
-        try:
-            self.article_index.put_item(
-                    Item={
-                        'Namespace': self.namespace,
-                        'Id': item['id'],
-                        'CrawlTime': item['crawl_time'],
-                        'Url': item['url'],
-                        'Spider': spider.name
-                    }
-                )
-        # according to http://stackoverflow.com/questions/16224819/dynamodb-handling-throttling-with-boto
-        # boto has internal retry, thus in case of error we do not have to
-        # retry
-        except ClientError:
-            pass
+        self._buffer.add({
+            'Namespace': self.namespace,
+            'Id': item['id'],
+            'CrawlTime': item['crawl_time'],
+            'Url': item['url'],
+            'Spider': spider.name
+        })
 
         return item
 
+    def flush(self):
+        """Write all buffered IDs to the index."""
+        self._buffer.flush()
+
+    def _write(self, items):
+        # one request must not contain the same key twice
+        unique_items = collections.OrderedDict(
+            ((item['Namespace'], item['Id']), item) for item in items)
+        items = list(unique_items.values())
+
+        for i in range(0, len(items), self.MAX_BATCH_SIZE):
+            try:
+                self._batch_write(items[i:i + self.MAX_BATCH_SIZE])
+            # according to http://stackoverflow.com/questions/16224819/dynamodb-handling-throttling-with-boto
+            # boto has internal retry, thus in case of error we do not have
+            # to retry
+            except ClientError:
+                logging.exception('Could not store IDs in DynamoDB')
+
     def close_spider(self, spider):
-        pass
+        self.flush()
+
+    def _batch_write(self, items):
+        table_name = self.article_index.name
+        request = {table_name: [{'PutRequest': {'Item': item}}
+                                for item in items]}
+
+        retries = 0
+        while request:
+            response = self.article_index.meta.client.batch_write_item(
+                RequestItems=request)
+
+            # DynamoDB returns items it could not process (e.g. when the
+            # table is throttled), they have to be written again
+            request = response.get('UnprocessedItems')
+            if request:
+                retries += 1
+                if retries > self.MAX_RETRIES:
+                    logging.error('DynamoDB did not store {} IDs'.format(
+                        len(request[table_name])))
+                    return
+                time.sleep(0.05 * 2 ** retries)
 
 
 class SaveDataToS3Pipeline(object):
@@ -110,43 +286,86 @@ class SaveDataToS3Pipeline(object):
     costs if a lot of items are scraped. Thus, this class
     performs buffering and will save files with multiple items in one file
     to S3.
+
+    A file is written once `max_items` items or `max_bytes` bytes of
+    serialized items are buffered for a spider, or when a new item
+    arrives and the oldest buffered item is older than `max_age`
+    seconds. Items are serialized when they arrive, so the buffered bytes
+    are known exactly.
+
+    Files can be compressed with gzip or zstd. If `upload_workers` is
+    larger than zero, compression and upload run in a pool of background
+    threads, at most `max_pending_uploads` files wait for a worker. If
+    this limit is reached, `process_item` blocks until a worker is free.
+    Large files are uploaded in parts of `multipart_threshold` bytes.
     """
     ITEMS_CACHE_MAXSIZE = 100
 
-    def __init__(self, s3_data, namespace):
+    def __init__(self, s3_data, namespace, compression=None,
+                 upload_workers=0, max_pending_uploads=4,
+                 multipart_threshold=8 * 1024 * 1024,
+                 max_items=ITEMS_CACHE_MAXSIZE, max_bytes=None,
+                 max_age=None, codec='json'):
+        if not skyscraper.serialization.get_codec(codec).is_json:
+            raise ValueError('Items can only be stored as JSON')
+
         self.namespace = namespace
+        self.codec = codec
 
         self.articles_data = s3_data
+        # serialized items and their crawl time per spider
         self.items_cache = collections.defaultdict(list)
+        self.buffered_bytes = collections.defaultdict(int)
+        self._buffer_started = {}
+
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self.compression = compression
+        self.transfer_config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_threshold)
+
+        self.upload_workers = upload_workers
+        self._uploads = None
+        self._upload_slots = threading.BoundedSemaphore(
+            upload_workers + max_pending_uploads)
+        self._pending_uploads = collections.defaultdict(list)
 
     @classmethod
     def from_crawler(cls, crawler):
         settings = crawler.settings
 
-        session = boto3.Session(
-            aws_access_key_id=settings.get('AWS_ACCESS_KEY'),
-            aws_secret_access_key=settings.get('AWS_SECRET_ACCESS_KEY'),
-            region_name='us-east-1'
-        )
-        s3 = session.resource('s3')
+        s3 = skyscraper.aws.get_resource('s3', settings)
         s3_data = s3.Bucket(settings.get('S3_DATA_BUCKET'))
 
         namespace = settings.get('USER_NAMESPACE')
-
-        return cls(s3_data, namespace)
+        compression = settings.get('S3_DATA_COMPRESSION') or None
+        upload_workers = settings.getint('S3_UPLOAD_WORKERS', 0)
+        max_pending_uploads = settings.getint('S3_MAX_PENDING_UPLOADS', 4)
+        multipart_threshold = settings.getint(
+            'S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024)
+        max_items = settings.getint(
+            'S3_FLUSH_MAX_ITEMS', cls.ITEMS_CACHE_MAXSIZE)
+        max_bytes = settings.getint('S3_FLUSH_MAX_BYTES') or None
+        max_age = settings.getfloat('S3_FLUSH_MAX_AGE') or None
+        codec = settings.get('SERIALIZATION_CODEC', 'json')
+
+        return cls(s3_data, namespace, compression, upload_workers,
+                   max_pending_uploads, multipart_threshold, max_items,
+                   max_bytes, max_age, codec)
 
     def process_item(self, item, spider):
-        # Store the meta info in our DynamoDB index
-        try:
-            self.items_cache[spider.name].append(item)
-        # according to http://stackoverflow.com/questions/16224819/dynamodb-handling-throttling-with-boto
-        # boto has internal retry, thus in case of error we do not have to
-        # retry
-        except ClientError:
-            pass
-
-        # if the items cache is large, flush it
-        if len(self.items_cache[spider.name]) > self.ITEMS_CACHE_MAXSIZE:
+        # items might be changed by later pipeline steps, so they are
+        # serialized immediately
+        line = skyscraper.serialization.serialize(item, self.codec)
+
+        self.items_cache[spider.name].append((item['crawl_time'], line))
+        self.buffered_bytes[spider.name] += len(line) + 1
+        self._buffer_started.setdefault(spider.name, time.monotonic())
+
+        if self._must_flush(spider.name):
             self._flush_cache_to_s3(spider.name)
 
         return item
@@ -156,29 +375,73 @@ class SaveDataToS3Pipeline(object):
         # time to make sure that all items are stored
         self._flush_cache_to_s3(spider.name)
 
-    def _flush_cache_to_s3(self, spider_name):
-        ie = self._get_exporter()
+        # wait for all uploads of this spider before it counts as finished,
+        # failed uploads have been logged already
+        concurrent.futures.wait(self._pending_uploads.pop(spider.name, []))
+
+        if self._uploads is not None and not self._pending_uploads:
+            self._uploads.shutdown()
+            self._uploads = None
+
+    def _must_flush(self, spider_name):
+        if len(self.items_cache[spider_name]) >= self.max_items:
+            return True
+        if self.max_bytes and self.buffered_bytes[spider_name] \
+                >= self.max_bytes:
+            return True
+        if self.max_age and time.monotonic() \
+                - self._buffer_started[spider_name] >= self.max_age:
+            return True
+        return False
 
+    def _flush_cache_to_s3(self, spider_name):
         items = self.items_cache[spider_name]
 
         if len(items) == 0:
             return
 
-        file_lines = []
-        for item in items:
-            exported = ie.export_item(item)
-            file_lines.append(json.dumps(exported))
+        file_lines = [line for _, line in items]
 
-        min_crawl_time = min([item['crawl_time'] for item in items])
-        max_crawl_time = max([item['crawl_time'] for item in items])
+        min_crawl_time = min([crawl_time for crawl_time, _ in items])
+        max_crawl_time = max([crawl_time for crawl_time, _ in items])
 
         # store the original source to S3
-        s3_key = '%s/%s/%s-to-%s.json' \
-            % (self.namespace, spider_name, min_crawl_time, max_crawl_time)
-
-        self.articles_data.put_object(Key=s3_key, Body='\n'.join(file_lines))
+        s3_key = '%s/%s/%s-to-%s.json%s' \
+            % (self.namespace, spider_name, min_crawl_time, max_crawl_time,
+               skyscraper.compression.EXTENSIONS[self.compression])
+        body = b'\n'.join(file_lines)
 
         self.items_cache.pop(spider_name, None)
+        self.buffered_bytes.pop(spider_name, None)
+        self._buffer_started.pop(spider_name, None)
+
+        if self.upload_workers <= 0:
+            self._upload(s3_key, body)
+        else:
+            if self._uploads is None:
+                self._uploads = concurrent.futures.ThreadPoolExecutor(
+                    self.upload_workers, thread_name_prefix='s3-upload')
+
+            # blocks if too many files are waiting for an upload already
+            self._upload_slots.acquire()
+            future = self._uploads.submit(self._upload, s3_key, body)
+            future.add_done_callback(self._upload_done)
+
+            pending = self._pending_uploads[spider_name]
+            pending[:] = [f for f in pending if not f.done()]
+            pending.append(future)
 
-    def _get_exporter(self, **kwargs):
-        return PythonItemExporter(binary=False, **kwargs)
+    def _upload(self, s3_key, body):
+        body = skyscraper.compression.compress(body, self.compression)
+
+        if len(body) < self.transfer_config.multipart_threshold:
+            self.articles_data.put_object(Key=s3_key, Body=body)
+        else:
+            self.articles_data.upload_fileobj(
+                io.BytesIO(body), s3_key, Config=self.transfer_config)
+
+    def _upload_done(self, future):
+        self._upload_slots.release()
+        if future.exception() is not None:
+            logging.error('Upload to S3 failed',
+                          exc_info=future.exception())
@@ -0,0 +1,37 @@
+import skyscraper.blobstore
+import skyscraper.serialization
+import skyscraper.storage
+
+
+class StoreSourceInBlobStorePipeline(object):
+    """This pipeline step moves the source of items into a
+    `skyscraper.blobstore.BlobStore`. The item keeps a reference in
+    `source_ref`, so that sources that did not change since the last
+    crawl are only stored once. Readers get the source back with
+    `skyscraper.blobstore.resolve_source`.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+
+        if settings.get('BLOB_STORE_S3_BUCKET'):
+            backend = skyscraper.storage.S3Storage.from_settings(
+                settings, settings.get('BLOB_STORE_S3_BUCKET'),
+                settings.get('BLOB_STORE_S3_PREFIX', ''))
+        else:
+            backend = skyscraper.storage.FolderStorage(
+                settings.get('BLOB_STORE_FOLDER'))
+
+        compression = settings.get('BLOB_STORE_COMPRESSION', 'zstd') or None
+        return cls(skyscraper.blobstore.BlobStore(backend, compression))
+
+    def process_item(self, item, spider):
+        if item.get('source'):
+            item['source_ref'] = self.store.put(item['source'])
+            del item['source']
+            skyscraper.serialization.forget(item)
+
+        return item
@@ -0,0 +1,157 @@
+import io
+import json
+import collections
+
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+
+import skyscraper.serialization
+import skyscraper.storage
+
+
+# fields of BasicItem that are stored as columns of their own,
+# `source_ref` is set instead of `source` if the blob store is used
+ITEM_COLUMNS = ['id', 'url', 'crawl_time', 'namespace', 'spider',
+                'source_ref']
+
+EXTENSIONS = {
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+}
+
+
+class SaveColumnarDataPipeline(object):
+    """This pipeline step stores items in batches as Parquet or Arrow IPC
+    files to a folder or an S3 bucket (see `skyscraper.storage`). Queries
+    on these files only have to read the columns they need.
+
+    Keys of `data` become columns of their own (`data.<key>`) if they
+    have the same scalar type in all items of a batch. All other keys are
+    kept as JSON in the column `data`. `source` is compressed with
+    `source_compression` (only Parquet can compress single columns, Arrow
+    files compress all columns then).
+    """
+    def __init__(self, target, namespace, file_format='parquet',
+                 max_items=10000, source_compression='zstd'):
+        if file_format not in EXTENSIONS:
+            raise ValueError('Unknown format "{}"'.format(file_format))
+
+        self.target = target
+        self.namespace = namespace
+        self.file_format = file_format
+        self.max_items = max_items
+        self.source_compression = source_compression
+
+        self.items_cache = collections.defaultdict(list)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+
+        if settings.get('COLUMNAR_OUTPUT_S3_BUCKET'):
+            target = skyscraper.storage.S3Storage.from_settings(
+                settings, settings.get('COLUMNAR_OUTPUT_S3_BUCKET'))
+        else:
+            target = skyscraper.storage.FolderStorage(
+                settings.get('COLUMNAR_OUTPUT_FOLDER'))
+
+        namespace = settings.get('USER_NAMESPACE')
+        file_format = settings.get('COLUMNAR_OUTPUT_FORMAT', 'parquet')
+        max_items = settings.getint('COLUMNAR_OUTPUT_MAX_ITEMS', 10000)
+        source_compression = settings.get(
+            'COLUMNAR_OUTPUT_SOURCE_COMPRESSION', 'zstd') or None
+
+        return cls(target, namespace, file_format, max_items,
+                   source_compression)
+
+    def process_item(self, item, spider):
+        self.items_cache[spider.name].append(
+            skyscraper.serialization.export(item))
+
+        if len(self.items_cache[spider.name]) >= self.max_items:
+            self._flush(spider.name)
+
+        return item
+
+    def close_spider(self, spider):
+        self._flush(spider.name)
+
+    def _flush(self, spider_name):
+        rows = self.items_cache.pop(spider_name, [])
+        if not rows:
+            return
+
+        table = items_to_table(rows)
+
+        f = io.BytesIO()
+        if self.file_format == 'parquet':
+            compression = {name: 'snappy' for name in table.column_names}
+            compression['source'] = self.source_compression or 'none'
+            pyarrow.parquet.write_table(table, f, compression=compression)
+        else:
+            options = pyarrow.ipc.IpcWriteOptions(
+                compression=self.source_compression)
+            with pyarrow.ipc.new_file(f, table.schema, options=options) \
+                    as writer:
+                writer.write_table(table)
+
+        min_crawl_time = min(row.get('crawl_time', '') for row in rows)
+        max_crawl_time = max(row.get('crawl_time', '') for row in rows)
+        key = '%s/%s/%s-to-%s%s' % (
+            self.namespace, spider_name, min_crawl_time, max_crawl_time,
+            EXTENSIONS[self.file_format])
+
+        self.target.write(key, f.getvalue())
+
+
+def items_to_table(rows):
+    """Convert exported items to a `pyarrow.Table`."""
+    columns = collections.OrderedDict()
+    for name in ITEM_COLUMNS:
+        columns[name] = pyarrow.array(
+            [row.get(name) for row in rows], pyarrow.string())
+
+    columns['source'] = pyarrow.array(
+        [row.get('source') for row in rows], pyarrow.string())
+
+    data = [row.get('data') or {} for row in rows]
+    data_columns = _stable_data_keys(data)
+    for key in data_columns:
+        columns['data.{}'.format(key)] = pyarrow.array(
+            [d.get(key) for d in data])
+
+    rest = []
+    for d in data:
+        other = {k: v for k, v in d.items() if k not in data_columns}
+        rest.append(json.dumps(other) if other else None)
+    columns['data'] = pyarrow.array(rest, pyarrow.string())
+
+    columns['downloads'] = pyarrow.array(
+        [json.dumps(row['downloads']) if row.get('downloads') else None
+         for row in rows], pyarrow.string())
+
+    return pyarrow.table(columns)
+
+
+def _stable_data_keys(data):
+    """Return the keys of `data` whose values have the same scalar type
+    in all items (or are missing).
+    """
+    types = {}
+    for d in data:
+        for key, value in d.items():
+            if value is None:
+                types.setdefault(key, None)
+                continue
+
+            value_type = type(value)
+            if value_type not in (str, int, float, bool):
+                value_type = object
+            if types.get(key) is None:
+                types[key] = value_type
+            elif types[key] != value_type:
+                types[key] = object
+
+    return sorted(key for key, value_type in types.items()
+                  if value_type is not None and value_type is not object)
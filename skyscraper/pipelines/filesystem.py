@@ -1,52 +1,319 @@
-import json
 import uuid
 import os
+import time
+import queue
+import logging
+import datetime
+import threading
+import functools
+import prometheus_client
 
-from scrapy.exporters import PythonItemExporter
 from scrapy.exceptions import DropItem
+from scrapy.crawler import Crawler
 
-from skyscraper.deduplication import DiskTrieDuplicatesFilter
+import skyscraper.instrumentation
+import skyscraper.serialization
+from skyscraper.batching import DuplicatesBatch
+from skyscraper.deduplication import DiskTrieDuplicatesFilter, \
+    ExpiringDuplicatesFilter
+
+
+STORAGE_QUEUE_DEPTH = prometheus_client.Gauge(
+    'skyscraper_storage_queue_depth',
+    'Number of items waiting to be written to the storage folder')
+STORAGE_WRITE_LATENCY = prometheus_client.Histogram(
+    'skyscraper_storage_write_seconds',
+    'Time to write and sync one batch of items to the storage folder')
 
 
 class SaveDataToFolderPipeline(object):
-    def __init__(self, folder, namespace):
+    """This pipeline step stores each item as a JSON file into a folder per
+    spider.
+
+    If `segments` is enabled, items are appended to JSON Lines segments
+    instead, one open segment per spider. A segment is closed once it has
+    `segment_max_bytes` bytes or is older than `segment_max_age` seconds.
+
+    If `background` is enabled, items are written by a `BackgroundWriter`
+    thread, so that slow disks do not block the crawl.
+
+    If `sync` is enabled in segment mode, open segments are fsynced after
+    each item, or once per batch of the background writer. Files of
+    single items are never synced.
+    """
+    def __init__(self, folder, namespace, segments=False,
+                 segment_max_bytes=64 * 1024 * 1024, segment_max_age=3600,
+                 background=False, queue_size=1000, codec='json',
+                 sync=False):
+        if not skyscraper.serialization.get_codec(codec).is_json:
+            raise ValueError('Items can only be stored as JSON')
+
         self.folder = folder
         self.namespace = namespace
+        self.codec = codec
+
+        self._background = None
+        if background:
+            self._background = BackgroundWriter(queue_size)
+
+        self.segments = segments
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_age = segment_max_age
+        self.sync = sync and segments
+        self._writers = {}
 
     @classmethod
     def from_crawler(cls, crawler):
         settings = crawler.settings
         folder = settings.get('SKYSCRAPER_STORAGE_FOLDER_PATH')
         namespace = settings.get('USER_NAMESPACE')
+        segments = settings.getbool('SKYSCRAPER_STORAGE_FOLDER_SEGMENTS')
+        segment_max_bytes = settings.getint(
+            'SKYSCRAPER_STORAGE_SEGMENT_MAX_BYTES', 64 * 1024 * 1024)
+        segment_max_age = settings.getfloat(
+            'SKYSCRAPER_STORAGE_SEGMENT_MAX_AGE', 3600)
+        background = settings.getbool('SKYSCRAPER_STORAGE_FOLDER_BACKGROUND')
+        queue_size = settings.getint(
+            'SKYSCRAPER_STORAGE_FOLDER_QUEUE_SIZE', 1000)
+        codec = settings.get('SERIALIZATION_CODEC', 'json')
+        sync = settings.getbool('SKYSCRAPER_STORAGE_FOLDER_SYNC')
 
-        return cls(folder, namespace)
+        return cls(folder, namespace, segments, segment_max_bytes,
+                   segment_max_age, background, queue_size, codec, sync)
 
     def process_item(self, item, spider):
-        target_dir = os.path.join(self.folder, self.namespace, spider.name)
+        # items might be changed by later pipeline steps, so they are
+        # serialized immediately
+        data = skyscraper.serialization.serialize(item, self.codec)
+
+        if self._background is not None:
+            self._background.submit(
+                functools.partial(self._write, spider.name, data))
+        else:
+            synced = self._write(spider.name, data)
+            if synced is not None:
+                synced.sync()
+
+        return item
+
+    def close_spider(self, spider):
+        if self._background is not None:
+            self._background.close()
+            self._background = None
+
+        writer = self._writers.pop(spider.name, None)
+        if writer is not None:
+            writer.close()
+
+    def _write(self, spider_name, data):
+        """Write one serialized item and return what has to be synced to
+        make it durable, if anything.
+        """
+        if self.segments:
+            writer = self._writer(spider_name)
+            writer.write(data)
+            return writer if self.sync else None
+
+        target_dir = os.path.join(self.folder, self.namespace, spider_name)
         os.makedirs(target_dir, exist_ok=True)
 
         random_id = str(uuid.uuid4())
         target_file = os.path.join(target_dir, '{}.json'.format(random_id))
 
-        ie = self._get_exporter()
-        exported = ie.export_item(item)
-        with open(target_file, 'w+') as f:
-            json.dump(exported, f)
+        with open(target_file, 'wb') as f:
+            f.write(data)
+        skyscraper.instrumentation.count_files(target_dir)
 
-        return item
+    def _writer(self, spider_name):
+        try:
+            return self._writers[spider_name]
+        except KeyError:
+            writer = SegmentWriter(
+                os.path.join(self.folder, self.namespace, spider_name),
+                self.segment_max_bytes, self.segment_max_age)
+            self._writers[spider_name] = writer
+            return writer
+
+
+class SegmentWriter(object):
+    """Appends lines to rolling JSON Lines segments in a directory.
+
+    The open segment is a hidden file, it is renamed to
+    `<start time>-<random id>.jl` when it is closed, so that readers only
+    ever see complete segments. Segments are rotated by size, by age and
+    at the start of each month, so that each segment belongs to one
+    archive month. Hidden segments of processes that died are completed
+    when a new writer starts.
+    """
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, max_age=3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        self._file = None
+        self._path = None
+        self._size = 0
+        self._started = None
+
+        os.makedirs(directory, exist_ok=True)
+        self._complete_orphaned_segments()
+
+    def write(self, line):
+        """Append one line, given as bytes without the line break."""
+        if self._file is None:
+            self._open()
+        elif self._must_rotate():
+            self.close()
+            self._open()
+
+        self._file.write(line)
+        self._file.write(b'\n')
+        self._size += len(line) + 1
+
+    def close(self):
+        if self._file is None:
+            return
+
+        self._file.close()
+        os.rename(self._path, self._final_path(self._path))
+        skyscraper.instrumentation.count_files(self.directory)
+        self._file = None
+
+    def sync(self):
+        """Make all lines written so far durable."""
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _must_rotate(self):
+        now = datetime.datetime.now()
+        return self._size >= self.max_bytes \
+            or (now - self._started).total_seconds() >= self.max_age \
+            or (now.year, now.month) != \
+            (self._started.year, self._started.month)
+
+    def _open(self):
+        self._started = datetime.datetime.now()
+        self._size = 0
+        self._path = os.path.join(self.directory, '.{}-{}-{}.jl.part'.format(
+            os.getpid(), self._started.strftime('%Y%m%dT%H%M%S'),
+            uuid.uuid4().hex))
+        self._file = open(self._path, 'ab', buffering=self.BUFFER_SIZE)
+
+    def _final_path(self, path):
+        # strip the leading dot, the PID and the suffix ".part"
+        _, _, name = os.path.basename(path)[1:-len('.part')].partition('-')
+        return os.path.join(os.path.dirname(path), name)
 
-    def _get_exporter(self, **kwargs):
-        return PythonItemExporter(binary=False, **kwargs)
+    def _complete_orphaned_segments(self):
+        for name in os.listdir(self.directory):
+            if not (name.startswith('.') and name.endswith('.jl.part')):
+                continue
+
+            pid = int(name[1:].partition('-')[0])
+            if not _process_exists(pid):
+                path = os.path.join(self.directory, name)
+                os.rename(path, self._final_path(path))
+                skyscraper.instrumentation.count_files(self.directory)
+
+
+class BackgroundWriter(object):
+    """Runs write operations in a thread. Writes wait in a queue of
+    `queue_size` entries, `submit` blocks if the queue is full.
+
+    Each write returns an object with a `sync` method (or None). The
+    thread runs up to `batch_size` queued writes and then syncs everything
+    they touched at once, so several items share one fsync.
+    """
+    def __init__(self, queue_size=1000, batch_size=100):
+        self.batch_size = batch_size
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(
+            target=self._run, name='background-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, write):
+        self._queue.put(write)
+        STORAGE_QUEUE_DEPTH.set(self._queue.qsize())
+
+    def close(self):
+        """Wait until all queued writes are done and stop the thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            STORAGE_QUEUE_DEPTH.set(self._queue.qsize())
+
+            start = time.monotonic()
+            to_sync = []
+            for write in batch:
+                if write is None:
+                    continue
+                try:
+                    synced = write()
+                    if synced is not None and synced not in to_sync:
+                        to_sync.append(synced)
+                except Exception:
+                    logging.exception('Could not store item')
+
+            for synced in to_sync:
+                try:
+                    synced.sync()
+                except Exception:
+                    logging.exception('Could not sync stored items')
+
+            if len(batch) > 1 or batch[0] is not None:
+                STORAGE_WRITE_LATENCY.observe(time.monotonic() - start)
+
+            if batch[-1] is None:
+                return
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
 
 
 class DiskDeduplicationPipeline(object):
     """This is a pipeline step that checks whether an item has already been
     scraped before. It will store item IDs into a deduplication filter and
     check for all new items whether they are already in the filter list.
+
+    If `batch_size` is larger than one, items are collected and checked
+    in bulk, once either `batch_size` items are pending or `batch_window`
+    seconds have passed. In this mode `process_item` returns a Deferred,
+    so it is only enabled for the scrapy engine.
+
+    If no filter is given, `filter_factory` is called with the spider
+    when the spider is opened. This allows a different filter per spider,
+    e.g. one that forgets IDs after the TTL of the spider.
     """
-    def __init__(self, duplicates_filter, namespace):
+    def __init__(self, duplicates_filter, namespace, batch_size=1,
+                 batch_window=1.0, filter_factory=None):
         self.namespace = namespace
         self.duplicates_filter = duplicates_filter
+        self.filter_factory = filter_factory
+
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._batch = DuplicatesBatch(
+            lambda combined_ids:
+                self.duplicates_filter.add_words_if_new(combined_ids),
+            batch_size, batch_window)
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -54,14 +321,96 @@ class DiskDeduplicationPipeline(object):
 
         namespace = settings.get('USER_NAMESPACE')
         folder = settings.get('DISK_DEDUPLICATION_FOLDER')
+        bucket_format = settings.get('DISK_DEDUPLICATION_FORMAT', 'text')
+        bloom_capacity = settings.getint('DISK_DEDUPLICATION_BLOOM_CAPACITY')
+        bloom_error_rate = settings.getfloat(
+            'DISK_DEDUPLICATION_BLOOM_ERROR_RATE', 0.01)
+        batch_size = settings.getint('DISK_DEDUPLICATION_BATCH_SIZE', 1)
+        batch_window = settings.getfloat(
+            'DISK_DEDUPLICATION_BATCH_WINDOW', 1.0)
+        locking = settings.getbool('DISK_DEDUPLICATION_LOCKING')
+        cache_size = settings.getint('DISK_DEDUPLICATION_CACHE_SIZE', 10000)
 
-        duplicates_filter = DiskTrieDuplicatesFilter(folder)
-        return cls(duplicates_filter, namespace)
+        # other engines (e.g. chrome) cannot handle Deferreds as results
+        # of a pipeline step, check each item on its own for them
+        if batch_size > 1 and not isinstance(crawler, Crawler):
+            logging.warning('DISK_DEDUPLICATION_BATCH_SIZE is only '
+                            'supported by the scrapy engine, ignoring it')
+            batch_size = 1
+
+        ttl_config = settings.get('DISK_DEDUPLICATION_TTL_DAYS')
+
+        def filter_factory(spider):
+            # spiders can override the configured TTL with an attribute
+            ttl_days = getattr(spider, 'deduplication_ttl_days', None)
+            if ttl_days is None:
+                ttl_days = deduplication_ttl_days(
+                    ttl_config, namespace, spider.name)
+
+            if ttl_days:
+                return ExpiringDuplicatesFilter(
+                    os.path.join(folder, 'expiring', namespace, spider.name),
+                    ttl_days * 24 * 60 * 60, bucket_format,
+                    bloom_capacity=bloom_capacity,
+                    bloom_error_rate=bloom_error_rate, locking=locking,
+                    cache_size=cache_size)
+            else:
+                return DiskTrieDuplicatesFilter(
+                    folder, bucket_format, bloom_capacity, bloom_error_rate,
+                    locking, cache_size)
+
+        return cls(None, namespace, batch_size, batch_window, filter_factory)
+
+    def open_spider(self, spider):
+        if self.duplicates_filter is None:
+            self.duplicates_filter = self.filter_factory(spider)
 
     def process_item(self, item, spider):
         combined_id = '{}-{}'.format(self.namespace, item['id'])
-        if self.duplicates_filter.has_word(combined_id):
+
+        if self.batch_size > 1:
+            # the IDs are stored before the items are passed on to the
+            # next pipeline steps
+            return self._batch.add(combined_id, item)
+
+        # check and insert in one step, so that no other process can
+        # insert the same ID in between
+        if not self.duplicates_filter.add_word_if_new(combined_id):
             raise DropItem("URL '%s' with item ID '%s' has already been crawled" % (item['url'], item['id']))
         else:
-            self.duplicates_filter.add_word(combined_id)
             return item
+
+    def flush(self):
+        """Check all pending items against the filter and fire their
+        Deferreds. New IDs are checked and added in one batch.
+        """
+        self._batch.flush()
+
+    def close_spider(self, spider):
+        self.flush()
+        self.duplicates_filter.close()
+
+
+def deduplication_ttl_days(config, namespace, spider):
+    """Return the TTL in days for the IDs of a spider or None if they
+    never expire.
+
+    `config` is either a number of days or a comma separated list of
+    `[namespace[/spider]=]days` entries, the most specific entry wins,
+    e.g. `30,news=7,news/ticker=1`.
+    """
+    if config is None or config == '':
+        return None
+    if isinstance(config, (int, float)):
+        return config
+
+    ttls = {}
+    for entry in str(config).split(','):
+        scope, _, days = entry.strip().rpartition('=')
+        ttls[scope.strip()] = float(days)
+
+    for scope in ('{}/{}'.format(namespace, spider), namespace, ''):
+        if scope in ttls:
+            return ttls[scope] or None
+
+    return None
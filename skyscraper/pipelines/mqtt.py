@@ -1,17 +1,17 @@
 # -*- coding: utf-8 -*-
 
-import json
 import datetime
 
-from scrapy.exporters import PythonItemExporter
-
 import paho.mqtt.client as mqtt
 
+import skyscraper.serialization
+
 
 class MqttOutputPipeline(object):
-    def __init__(self, paho_client, namespace):
+    def __init__(self, paho_client, namespace, codec='json'):
         self.namespace = namespace
         self.paho_client = paho_client
+        self.codec = codec
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -25,18 +25,14 @@ class MqttOutputPipeline(object):
         mqtt_client.connect(mqtt_host, mqtt_port, 60)
         mqtt_client.loop_start()
 
-        return cls(mqtt_client, namespace)
+        codec = settings.get('SERIALIZATION_CODEC', 'json')
 
-    def process_item(self, item, spider):
-        ie = self._get_exporter()
-        exported = ie.export_item(item)
+        return cls(mqtt_client, namespace, codec)
 
+    def process_item(self, item, spider):
         # send result to messaging queue
-        payload = json.dumps(exported)
+        payload = skyscraper.serialization.serialize(item, self.codec)
         self.paho_client.publish(
             'skyscraper/items/%s/%s' % (self.namespace, spider.name), payload)
 
         return item
-
-    def _get_exporter(self, **kwargs):
-        return PythonItemExporter(binary=False, **kwargs)
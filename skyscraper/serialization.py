@@ -0,0 +1,122 @@
+"""Serialization of items for all output pipelines.
+
+Each item is exported and encoded only once per codec, the result is
+cached with the item and reused by every later pipeline step. Items must
+not be changed after the first output pipeline serialized them, call
+`forget` if a pipeline step has to change an item anyway.
+"""
+
+import json
+
+from scrapy.exporters import PythonItemExporter
+
+import skyscraper.instrumentation
+
+
+class JsonCodec(object):
+    name = 'json'
+    is_json = True
+
+    def encode(self, value):
+        return json.dumps(value).encode('utf-8')
+
+
+class OrjsonCodec(object):
+    """JSON with orjson, which is several times faster on large items."""
+    name = 'orjson'
+    is_json = True
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def encode(self, value):
+        return self._orjson.dumps(value)
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+    is_json = False
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def encode(self, value):
+        return self._msgpack.packb(value, use_bin_type=True)
+
+
+CODECS = {
+    'json': JsonCodec,
+    'orjson': OrjsonCodec,
+    'msgpack': MsgpackCodec,
+}
+
+_codecs = {}
+_exporter = PythonItemExporter(binary=False)
+
+# attribute of scrapy items that holds the cache
+_CACHE_ATTRIBUTE = '_skyscraper_serialized'
+
+
+def get_codec(name='json'):
+    """Return the codec with this name, its package has to be installed."""
+    try:
+        return _codecs[name]
+    except KeyError:
+        if name not in CODECS:
+            raise ValueError('Unknown codec "{}"'.format(name))
+        try:
+            codec = CODECS[name]()
+        except ImportError:
+            raise RuntimeError(
+                'The codec "{}" requires the package {}'.format(name, name))
+        _codecs[name] = codec
+        return codec
+
+
+def export(item):
+    """Return the item as a dictionary of plain Python values."""
+    cache = _cache(item)
+    if cache is None:
+        return _exporter.export_item(item)
+
+    if None not in cache:
+        cache[None] = _exporter.export_item(item)
+    return cache[None]
+
+
+def serialize(item, codec='json'):
+    """Return the item encoded with `codec` as bytes."""
+    cache = _cache(item)
+    if cache is not None and codec in cache:
+        return cache[codec]
+
+    data = get_codec(codec).encode(export(item))
+    skyscraper.instrumentation.SERIALIZED_BYTES.labels(
+        namespace=item.get('namespace') or '',
+        spider=item.get('spider') or '',
+        codec=codec).inc(len(data))
+
+    if cache is not None:
+        cache[codec] = data
+    return data
+
+
+def forget(item):
+    """Remove the cached serializations of an item after it changed."""
+    if _CACHE_ATTRIBUTE in getattr(item, '__dict__', {}):
+        delattr(item, _CACHE_ATTRIBUTE)
+
+
+def _cache(item):
+    # plain dicts cannot hold attributes, they are serialized every time
+    if isinstance(item, dict):
+        return None
+
+    try:
+        return getattr(item, _CACHE_ATTRIBUTE)
+    except AttributeError:
+        cache = {}
+        setattr(item, _CACHE_ATTRIBUTE, cache)
+        return cache
@@ -27,6 +27,9 @@ ROBOTSTXT_OBEY = True
 DOWNLOAD_DELAY = 0.1
 
 
+# Records latency and outcome of every pipeline step
+ITEM_PROCESSOR = 'skyscraper.instrumentation.InstrumentedItemPipelineManager'
+
 ITEM_PIPELINES = {
     'skyscraper.pipelines.metainfo.AddNamespacePipeline': 100,
     'skyscraper.pipelines.metainfo.AddSpiderNamePipeline': 101,
@@ -39,6 +42,45 @@ if os.environ.get('SKYSCRAPER_PIPELINE_USE_DUPLICATESFILTER_DISK') \
 
     DISK_DEDUPLICATION_FOLDER = os.environ.get('SKYSCRAPER_DISK_DEDUPLICATION_FOLDER')
 
+    # "text" (unsorted, append-only), "sorted" (binary searchable),
+    # "frontcoded" (sorted and prefix compressed) or "digest" (sorted
+    # 16 byte hashes of the IDs)
+    if os.environ.get('SKYSCRAPER_DISK_DEDUPLICATION_FORMAT'):
+        DISK_DEDUPLICATION_FORMAT = os.environ.get('SKYSCRAPER_DISK_DEDUPLICATION_FORMAT')
+    else:
+        DISK_DEDUPLICATION_FORMAT = 'text'
+
+    # A bloom filter in front of the buckets is used if a capacity
+    # (expected number of IDs) is set
+    if os.environ.get('SKYSCRAPER_DISK_DEDUPLICATION_BLOOM_CAPACITY'):
+        DISK_DEDUPLICATION_BLOOM_CAPACITY = int(os.environ.get('SKYSCRAPER_DISK_DEDUPLICATION_BLOOM_CAPACITY'))
+    if os.environ.get('SKYSCRAPER_DISK_DEDUPLICATION_BLOOM_ERROR_RATE'):
+        DISK_DEDUPLICATION_BLOOM_ERROR_RATE = float(os.environ.get('SKYSCRAPER_DISK_DEDUPLICATION_BLOOM_ERROR_RATE'))
+
+    # Lock the buckets, required if several spiders run in parallel
+    if os.environ.get('SKYSCRAPER_DISK_DEDUPLICATION_LOCKING'):
+        DISK_DEDUPLICATION_LOCKING = bool(int(os.environ.get('SKYSCRAPER_DISK_DEDUPLICATION_LOCKING')))
+
+    # Number of recently seen IDs that are kept in memory (0 disables
+    # the cache)
+    if os.environ.get('SKYSCRAPER_DISK_DEDUPLICATION_CACHE_SIZE'):
+        DISK_DEDUPLICATION_CACHE_SIZE = int(os.environ.get('SKYSCRAPER_DISK_DEDUPLICATION_CACHE_SIZE'))
+    else:
+        DISK_DEDUPLICATION_CACHE_SIZE = 10000
+
+    # Forget IDs after this number of days, either one value for all
+    # spiders or a list like "30,namespace=7,namespace/spider=1". Spiders
+    # can override it with a `deduplication_ttl_days` attribute
+    if os.environ.get('SKYSCRAPER_DISK_DEDUPLICATION_TTL_DAYS'):
+        DISK_DEDUPLICATION_TTL_DAYS = os.environ.get('SKYSCRAPER_DISK_DEDUPLICATION_TTL_DAYS')
+
+    # Check items in batches of this size (at most BATCH_WINDOW seconds
+    # delay), this only works with the scrapy engine
+    if os.environ.get('SKYSCRAPER_DISK_DEDUPLICATION_BATCH_SIZE'):
+        DISK_DEDUPLICATION_BATCH_SIZE = int(os.environ.get('SKYSCRAPER_DISK_DEDUPLICATION_BATCH_SIZE'))
+    if os.environ.get('SKYSCRAPER_DISK_DEDUPLICATION_BATCH_WINDOW'):
+        DISK_DEDUPLICATION_BATCH_WINDOW = float(os.environ.get('SKYSCRAPER_DISK_DEDUPLICATION_BATCH_WINDOW'))
+
 if os.environ.get('SKYSCRAPER_PIPELINE_USE_DUPLICATESFILTER_DYNAMODB') \
         and int(os.environ.get('SKYSCRAPER_PIPELINE_USE_DUPLICATESFILTER_DYNAMODB')):
     ITEM_PIPELINES['skyscraper.pipelines.aws.DoNotStoreDuplicatesPipeline'] = 200
@@ -46,19 +88,118 @@ if os.environ.get('SKYSCRAPER_PIPELINE_USE_DUPLICATESFILTER_DYNAMODB') \
     # should be immediately after SaveDataPipeline
     ITEM_PIPELINES['skyscraper.pipelines.aws.StoreItemToDuplicateFilterPipeline'] = 301
 
+    # Check items with BatchGetItem requests of this size (at most 100,
+    # at most BATCH_WINDOW seconds delay), only works with scrapy
+    if os.environ.get('SKYSCRAPER_DYNAMODB_DEDUPLICATION_BATCH_SIZE'):
+        DYNAMODB_DEDUPLICATION_BATCH_SIZE = int(os.environ.get('SKYSCRAPER_DYNAMODB_DEDUPLICATION_BATCH_SIZE'))
+    if os.environ.get('SKYSCRAPER_DYNAMODB_DEDUPLICATION_BATCH_WINDOW'):
+        DYNAMODB_DEDUPLICATION_BATCH_WINDOW = float(os.environ.get('SKYSCRAPER_DYNAMODB_DEDUPLICATION_BATCH_WINDOW'))
+
+    # Write IDs with BatchWriteItem once this number of items is
+    # buffered or the oldest one is older than BUFFER_SECONDS
+    if os.environ.get('SKYSCRAPER_DYNAMODB_WRITE_BUFFER_SIZE'):
+        DYNAMODB_WRITE_BUFFER_SIZE = int(os.environ.get('SKYSCRAPER_DYNAMODB_WRITE_BUFFER_SIZE'))
+    if os.environ.get('SKYSCRAPER_DYNAMODB_WRITE_BUFFER_SECONDS'):
+        DYNAMODB_WRITE_BUFFER_SECONDS = float(os.environ.get('SKYSCRAPER_DYNAMODB_WRITE_BUFFER_SECONDS'))
+
+    # Number of IDs known to be crawled that are kept in memory
+    if os.environ.get('SKYSCRAPER_DYNAMODB_DEDUPLICATION_CACHE_SIZE'):
+        DYNAMODB_DEDUPLICATION_CACHE_SIZE = int(os.environ.get('SKYSCRAPER_DYNAMODB_DEDUPLICATION_CACHE_SIZE'))
+
 if os.environ.get('SKYSCRAPER_PIPELINE_USE_OUTPUT_FOLDER') \
         and int(os.environ.get('SKYSCRAPER_PIPELINE_USE_OUTPUT_FOLDER')):
     ITEM_PIPELINES['skyscraper.pipelines.filesystem.SaveDataToFolderPipeline'] = 300
     SKYSCRAPER_STORAGE_FOLDER_PATH = os.environ.get('SKYSCRAPER_STORAGE_FOLDER_PATH')
 
+    # File counts are updated from changes recorded by the writers,
+    # changed spider folders are listed again after this number of seconds
+    if os.environ.get('SKYSCRAPER_NUM_FILES_RECONCILE_INTERVAL'):
+        SKYSCRAPER_NUM_FILES_RECONCILE_INTERVAL = float(os.environ.get('SKYSCRAPER_NUM_FILES_RECONCILE_INTERVAL'))
+
+    # Append items to JSON Lines segments instead of one file per item,
+    # a segment is closed at MAX_BYTES bytes or after MAX_AGE seconds
+    if os.environ.get('SKYSCRAPER_STORAGE_FOLDER_SEGMENTS'):
+        SKYSCRAPER_STORAGE_FOLDER_SEGMENTS = bool(int(os.environ.get('SKYSCRAPER_STORAGE_FOLDER_SEGMENTS')))
+    if os.environ.get('SKYSCRAPER_STORAGE_SEGMENT_MAX_BYTES'):
+        SKYSCRAPER_STORAGE_SEGMENT_MAX_BYTES = int(os.environ.get('SKYSCRAPER_STORAGE_SEGMENT_MAX_BYTES'))
+    if os.environ.get('SKYSCRAPER_STORAGE_SEGMENT_MAX_AGE'):
+        SKYSCRAPER_STORAGE_SEGMENT_MAX_AGE = float(os.environ.get('SKYSCRAPER_STORAGE_SEGMENT_MAX_AGE'))
+
+    # Write items in a background thread with a queue of QUEUE_SIZE items
+    if os.environ.get('SKYSCRAPER_STORAGE_FOLDER_BACKGROUND'):
+        SKYSCRAPER_STORAGE_FOLDER_BACKGROUND = bool(int(os.environ.get('SKYSCRAPER_STORAGE_FOLDER_BACKGROUND')))
+    if os.environ.get('SKYSCRAPER_STORAGE_FOLDER_QUEUE_SIZE'):
+        SKYSCRAPER_STORAGE_FOLDER_QUEUE_SIZE = int(os.environ.get('SKYSCRAPER_STORAGE_FOLDER_QUEUE_SIZE'))
+
+    # fsync open segments after writing (once per batch in the background)
+    if os.environ.get('SKYSCRAPER_STORAGE_FOLDER_SYNC'):
+        SKYSCRAPER_STORAGE_FOLDER_SYNC = bool(int(os.environ.get('SKYSCRAPER_STORAGE_FOLDER_SYNC')))
+
+# Store items in batches as Parquet or Arrow files to a folder or to S3
+if os.environ.get('SKYSCRAPER_PIPELINE_USE_OUTPUT_COLUMNAR') \
+        and int(os.environ.get('SKYSCRAPER_PIPELINE_USE_OUTPUT_COLUMNAR')):
+    ITEM_PIPELINES['skyscraper.pipelines.columnar.SaveColumnarDataPipeline'] = 300
+    COLUMNAR_OUTPUT_FOLDER = os.environ.get('SKYSCRAPER_COLUMNAR_OUTPUT_FOLDER')
+    COLUMNAR_OUTPUT_S3_BUCKET = os.environ.get('SKYSCRAPER_COLUMNAR_OUTPUT_S3_BUCKET')
+
+    # "parquet" or "arrow"
+    if os.environ.get('SKYSCRAPER_COLUMNAR_OUTPUT_FORMAT'):
+        COLUMNAR_OUTPUT_FORMAT = os.environ.get('SKYSCRAPER_COLUMNAR_OUTPUT_FORMAT')
+    if os.environ.get('SKYSCRAPER_COLUMNAR_OUTPUT_MAX_ITEMS'):
+        COLUMNAR_OUTPUT_MAX_ITEMS = int(os.environ.get('SKYSCRAPER_COLUMNAR_OUTPUT_MAX_ITEMS'))
+    # empty to store the source uncompressed
+    if os.environ.get('SKYSCRAPER_COLUMNAR_OUTPUT_SOURCE_COMPRESSION') is not None:
+        COLUMNAR_OUTPUT_SOURCE_COMPRESSION = os.environ.get('SKYSCRAPER_COLUMNAR_OUTPUT_SOURCE_COMPRESSION')
+
+# Store the source of items only once in a content-addressed blob store
+# (a folder or S3), items keep a reference in source_ref
+if os.environ.get('SKYSCRAPER_PIPELINE_USE_BLOB_STORE') \
+        and int(os.environ.get('SKYSCRAPER_PIPELINE_USE_BLOB_STORE')):
+    ITEM_PIPELINES['skyscraper.pipelines.blobs.StoreSourceInBlobStorePipeline'] = 250
+    BLOB_STORE_FOLDER = os.environ.get('SKYSCRAPER_BLOB_STORE_FOLDER')
+    BLOB_STORE_S3_BUCKET = os.environ.get('SKYSCRAPER_BLOB_STORE_S3_BUCKET')
+    if os.environ.get('SKYSCRAPER_BLOB_STORE_S3_PREFIX'):
+        BLOB_STORE_S3_PREFIX = os.environ.get('SKYSCRAPER_BLOB_STORE_S3_PREFIX')
+    # "zstd" (default), "gzip" or empty for no compression
+    if os.environ.get('SKYSCRAPER_BLOB_STORE_COMPRESSION') is not None:
+        BLOB_STORE_COMPRESSION = os.environ.get('SKYSCRAPER_BLOB_STORE_COMPRESSION')
+
 if os.environ.get('SKYSCRAPER_CHROME_NO_SANDBOX'):
     SKYSCRAPER_CHROME_NO_SANDBOX = bool(os.environ.get('SKYSCRAPER_CHROME_NO_SANDBOX'))
 else:
     SKYSCRAPER_CHROME_NO_SANDBOX = False
 
+# Encoding of items in all output pipelines: "json", "orjson" (faster)
+# or "msgpack" (MQTT only)
+SERIALIZATION_CODEC = os.environ.get('SKYSCRAPER_SERIALIZATION_CODEC', 'json')
+
 # Connection to AWS
 AWS_ACCESS_KEY = os.environ.get('SKYSCRAPER_AWS_ACCESS_KEY')
 AWS_SECRET_ACCESS_KEY = os.environ.get('SKYSCRAPER_AWS_SECRET_ACCESS_KEY')
+AWS_REGION = os.environ.get('SKYSCRAPER_AWS_REGION', 'us-east-1')
+# All AWS pipelines of a process share one connection pool per service
+if os.environ.get('SKYSCRAPER_AWS_MAX_POOL_CONNECTIONS'):
+    AWS_MAX_POOL_CONNECTIONS = int(os.environ.get('SKYSCRAPER_AWS_MAX_POOL_CONNECTIONS'))
+if os.environ.get('SKYSCRAPER_AWS_TCP_KEEPALIVE'):
+    AWS_TCP_KEEPALIVE = bool(int(os.environ.get('SKYSCRAPER_AWS_TCP_KEEPALIVE')))
+
+# Items stored by SaveDataToS3Pipeline, files can be compressed with
+# "gzip" or "zstd" and uploaded by background threads
+S3_DATA_BUCKET = os.environ.get('SKYSCRAPER_S3_DATA_BUCKET')
+S3_DATA_COMPRESSION = os.environ.get('SKYSCRAPER_S3_DATA_COMPRESSION')
+# A file is written once one of these limits is reached for a spider
+if os.environ.get('SKYSCRAPER_S3_FLUSH_MAX_ITEMS'):
+    S3_FLUSH_MAX_ITEMS = int(os.environ.get('SKYSCRAPER_S3_FLUSH_MAX_ITEMS'))
+if os.environ.get('SKYSCRAPER_S3_FLUSH_MAX_BYTES'):
+    S3_FLUSH_MAX_BYTES = int(os.environ.get('SKYSCRAPER_S3_FLUSH_MAX_BYTES'))
+if os.environ.get('SKYSCRAPER_S3_FLUSH_MAX_AGE'):
+    S3_FLUSH_MAX_AGE = float(os.environ.get('SKYSCRAPER_S3_FLUSH_MAX_AGE'))
+if os.environ.get('SKYSCRAPER_S3_UPLOAD_WORKERS'):
+    S3_UPLOAD_WORKERS = int(os.environ.get('SKYSCRAPER_S3_UPLOAD_WORKERS'))
+if os.environ.get('SKYSCRAPER_S3_MAX_PENDING_UPLOADS'):
+    S3_MAX_PENDING_UPLOADS = int(os.environ.get('SKYSCRAPER_S3_MAX_PENDING_UPLOADS'))
+if os.environ.get('SKYSCRAPER_S3_MULTIPART_THRESHOLD'):
+    S3_MULTIPART_THRESHOLD = int(os.environ.get('SKYSCRAPER_S3_MULTIPART_THRESHOLD'))
 
 if os.environ.get('SKYSCRAPER_SPIDER_LOADER_CLASS'):
     SPIDER_LOADER_CLASS = os.environ.get('SKYSCRAPER_SPIDER_LOADER_CLASS')
@@ -72,3 +213,10 @@ GIT_REPOSITORY = os.environ.get('SKYSCRAPER_GIT_REPOSITORY')
 GIT_WORKDIR = os.environ.get('SKYSCRAPER_GIT_WORKDIR')
 GIT_SUBFOLDER = os.environ.get('SKYSCRAPER_GIT_SUBFOLDER')
 GIT_BRANCH = os.environ.get('SKYSCRAPER_GIT_BRANCH')
+
+# Statistics of the last spider runs are kept in this JSON lines file
+RUN_HISTORY_FILE = os.environ.get('SKYSCRAPER_RUN_HISTORY_FILE')
+if os.environ.get('SKYSCRAPER_RUN_HISTORY_SIZE'):
+    RUN_HISTORY_SIZE = int(os.environ.get('SKYSCRAPER_RUN_HISTORY_SIZE'))
+else:
+    RUN_HISTORY_SIZE = 1000
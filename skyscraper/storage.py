@@ -0,0 +1,61 @@
+"""Places where Skyscraper writes whole files, e.g. columnar output or
+blobs. Keys are relative paths like `namespace/spider/file`.
+"""
+
+import os
+import uuid
+
+
+class FolderStorage(object):
+    """Stores files below a local folder."""
+    def __init__(self, folder):
+        self.folder = folder
+
+    def exists(self, key):
+        return os.path.isfile(os.path.join(self.folder, key))
+
+    def write(self, key, data):
+        path = os.path.join(self.folder, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # readers must never see incomplete files
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def read(self, key):
+        with open(os.path.join(self.folder, key), 'rb') as f:
+            return f.read()
+
+
+class S3Storage(object):
+    """Stores files in an S3 bucket, below `prefix`."""
+    def __init__(self, bucket, prefix=''):
+        self.bucket = bucket
+        self.prefix = prefix
+
+    @classmethod
+    def from_settings(cls, settings, bucket_name, prefix=''):
+        # boto3 is only required if S3 is used
+        import skyscraper.aws
+
+        s3 = skyscraper.aws.get_resource('s3', settings)
+        return cls(s3.Bucket(bucket_name), prefix)
+
+    def exists(self, key):
+        import botocore.exceptions
+
+        try:
+            self.bucket.Object(self.prefix + key).load()
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise
+
+    def write(self, key, data):
+        self.bucket.put_object(Key=self.prefix + key, Body=data)
+
+    def read(self, key):
+        return self.bucket.Object(self.prefix + key).get()['Body'].read()
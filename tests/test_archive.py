@@ -2,8 +2,11 @@ import tempfile
 import datetime
 import time
 import os
+import gzip
+import json
 
 import skyscraper.archive
+import skyscraper.instrumentation
 
 
 def test_archive_old_files(tmpdir):
@@ -53,3 +56,107 @@ def test_archive_old_files(tmpdir):
         # The file from this month should still exist
         assert os.path.isfile(f_1.name)
         assert not os.path.isfile(os.path.join(tmpdir, this_month_file))
+
+        # three files were archived into two archives with an index each
+        with open(os.path.join(
+                tmpdir, skyscraper.instrumentation.FILE_COUNT_JOURNAL)) as f:
+            assert sum(int(line) for line in f) == 1
+
+
+def test_archive_old_segments(tmpdir):
+    last_month = datetime.datetime.today().replace(day=1) \
+        - datetime.timedelta(days=15)
+    last_month_time = time.mktime(last_month.timetuple())
+
+    segment = tmpdir.join('segment.jl')
+    segment.write('{"foo": "data_1"}\n{"foo": "data_2"}\n')
+    open_segment = tmpdir.join('.1-segment.jl.part')
+    open_segment.write('{"foo": "data_3"}\n')
+    for f in (segment, open_segment):
+        os.utime(str(f), (last_month_time, last_month_time))
+
+    skyscraper.archive.archive_old_files(str(tmpdir))
+
+    archive = tmpdir.join(last_month.strftime('%Y-%m.jl.gz'))
+    with gzip.open(str(archive), 'rt') as f:
+        assert f.read().splitlines() == \
+            ['{"foo": "data_1"}', '{"foo": "data_2"}']
+
+    # segments that are still written are not archived
+    assert open_segment.isfile()
+
+
+def test_archive_reader_finds_items_by_id_and_time(tmpdir):
+    path = str(tmpdir.join('2018-01.jl.gz'))
+    with open(path, 'wb') as f, \
+            open(path + skyscraper.archive.INDEX_SUFFIX, 'wb') as index:
+        writer = skyscraper.archive.BlockWriter(f, index, block_size=100)
+        for i in range(20):
+            writer.write(json.dumps({
+                'id': 'id-{}'.format(i),
+                'crawl_time': '2018-01-{:02d}T12:00:00Z'.format(i + 1),
+            }).encode('utf-8'))
+        writer.close()
+
+    # the archive is still a normal gzip file
+    with gzip.open(path, 'rt') as f:
+        assert len(f.read().splitlines()) == 20
+
+    reader = skyscraper.archive.ArchiveReader(path)
+    assert len(list(reader)) == 20
+    assert reader.find('id-13')['crawl_time'] == '2018-01-14T12:00:00Z'
+    assert reader.find('unknown') is None
+    assert [item['id'] for item in reader.items_between(
+        '2018-01-05', '2018-01-07')] == ['id-4', 'id-5']
+
+    # archives without an index are scanned
+    os.remove(path + skyscraper.archive.INDEX_SUFFIX)
+    reader = skyscraper.archive.ArchiveReader(path)
+    assert reader.find('id-13')['id'] == 'id-13'
+
+
+def test_archiving_appends_and_recovers_from_interruption(tmpdir):
+    last_month = datetime.datetime.today().replace(day=1) \
+        - datetime.timedelta(days=15)
+    last_month_time = time.mktime(last_month.timetuple())
+    archive = tmpdir.join(last_month.strftime('%Y-%m.jl.gz'))
+
+    def add_item(name):
+        f = tmpdir.join(name)
+        f.write(json.dumps({'id': name}))
+        os.utime(str(f), (last_month_time, last_month_time))
+
+    add_item('item-1.json')
+    skyscraper.archive.archive_old_files(str(tmpdir))
+
+    # a run that was interrupted while it appended item-2
+    add_item('item-2.json')
+    manifest = skyscraper.archive.read_manifest(str(tmpdir))
+    entry = manifest[archive.basename]
+    entry['pending'] = True
+    skyscraper.archive._save_manifest(str(tmpdir), manifest)
+    with open(str(archive), 'ab') as f:
+        f.write(gzip.compress(b'{"id": "item-2.json"}\n')[:10])
+
+    add_item('item-3.json')
+    add_item('item-4.json')
+    skyscraper.archive.archive_old_files(str(tmpdir))
+
+    reader = skyscraper.archive.ArchiveReader(str(archive))
+    assert sorted(item['id'] for item in reader) == \
+        ['item-1.json', 'item-2.json', 'item-3.json', 'item-4.json']
+    assert reader.find('item-1.json') is not None
+    assert reader.find('item-4.json') is not None
+    assert skyscraper.archive.read_manifest(str(tmpdir))[
+        archive.basename]['files'] == 4
+
+
+def test_archiving_removes_inputs_of_committed_batch(tmpdir):
+    tmpdir.join('item.json').write('{"id": "item"}')
+    skyscraper.archive._save_manifest(str(tmpdir), {'2018-01.jl.gz': {
+        'size': 0, 'indexed': True, 'index_size': 0, 'files': 1,
+        'pending': False, 'inputs': ['item.json']}})
+
+    skyscraper.archive.archive_old_files(str(tmpdir))
+
+    assert not tmpdir.join('item.json').exists()
@@ -0,0 +1,22 @@
+from scrapy.settings import Settings
+
+import skyscraper.aws
+
+
+def test_resources_are_shared_between_pipelines():
+    skyscraper.aws.clear_resources()
+    settings = Settings({
+        'AWS_ACCESS_KEY': 'dummy',
+        'AWS_SECRET_ACCESS_KEY': 'dummy',
+        'AWS_MAX_POOL_CONNECTIONS': 25,
+    })
+
+    s3 = skyscraper.aws.get_resource('s3', settings)
+    assert skyscraper.aws.get_resource('s3', settings) is s3
+    assert s3.meta.client.meta.config.max_pool_connections == 25
+    assert s3.meta.client.meta.region_name == 'us-east-1'
+
+    settings.set('AWS_REGION', 'eu-central-1')
+    other = skyscraper.aws.get_resource('s3', settings)
+    assert other is not s3
+    assert other.meta.client.meta.region_name == 'eu-central-1'
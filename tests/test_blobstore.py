@@ -0,0 +1,56 @@
+import moto
+import boto3
+import pytest
+
+from scrapy.spiders import Spider
+
+from skyscraper.items import BasicItem
+from skyscraper.blobstore import BlobStore
+from skyscraper.blobstore import resolve_source
+from skyscraper.pipelines.blobs import StoreSourceInBlobStorePipeline
+from skyscraper.storage import FolderStorage
+from skyscraper.storage import S3Storage
+
+
+def test_pipeline_stores_each_source_once(tmpdir):
+    store = BlobStore(FolderStorage(str(tmpdir)), compression='gzip')
+    pipeline = StoreSourceInBlobStorePipeline(store)
+
+    spider = Spider(name='spider')
+    refs = []
+    for i in range(3):
+        item = BasicItem()
+        item['id'] = 'id-{}'.format(i)
+        item['source'] = '<html>same page</html>'
+        item = pipeline.process_item(item, spider)
+
+        assert 'source' not in item
+        assert resolve_source(item, store) == '<html>same page</html>'
+        refs.append(item['source_ref'])
+
+    assert len(set(refs)) == 1
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_s3_storage(monkeypatch):
+    # moto cannot decode bodies with checksum trailers
+    monkeypatch.setenv('AWS_REQUEST_CHECKSUM_CALCULATION', 'when_required')
+
+    with moto.mock_s3():
+        s3 = boto3.Session(
+            aws_access_key_id='dummy',
+            aws_secret_access_key='dummy'
+        ).resource('s3', region_name='us-east-1')
+        bucket = s3.create_bucket(Bucket='skyscraper-blobs')
+
+        backend = S3Storage(bucket, 'sources/')
+        assert not backend.exists('ab/abc')
+        backend.write('ab/abc', b'data')
+        assert backend.exists('ab/abc')
+
+        store = BlobStore(backend, compression=None)
+        ref = store.put(b'data')
+        assert store.get(ref) == b'data'
+
+        with pytest.raises(ValueError):
+            store.get('md5:abc')
@@ -0,0 +1,69 @@
+import os
+import time
+import datetime
+import tempfile
+
+from click.testing import CliRunner
+
+from skyscraper.commands import skyscraper_archive
+from skyscraper.commands import skyscraper_dedup_convert
+from skyscraper.deduplication import DiskTrieDuplicatesFilter
+import skyscraper.settings
+
+
+def test_dedup_convert_detects_source_format(monkeypatch):
+    triedir = tempfile.mkdtemp()
+    monkeypatch.setenv('SKYSCRAPER_DISK_DEDUPLICATION_FORMAT', 'frontcoded')
+
+    f = DiskTrieDuplicatesFilter(triedir, 'text')
+    f.add_words(['foo', 'bar'])
+    f.close()
+
+    runner = CliRunner()
+    result = runner.invoke(
+        skyscraper_dedup_convert, ['frontcoded', '--folder', triedir])
+    assert result.exit_code == 0
+
+    f = DiskTrieDuplicatesFilter(triedir, 'frontcoded')
+    assert f.has_word('foo')
+    assert f.has_word('bar')
+    f.close()
+
+
+def test_dedup_convert_fails_for_wrong_source_format():
+    triedir = tempfile.mkdtemp()
+
+    f = DiskTrieDuplicatesFilter(triedir, 'text')
+    f.add_word('foo')
+    f.close()
+
+    runner = CliRunner()
+    result = runner.invoke(
+        skyscraper_dedup_convert,
+        ['frontcoded', '--folder', triedir, '--source-format', 'sorted'])
+    assert result.exit_code != 0
+
+
+def test_archive_processes_all_spider_folders(tmpdir, monkeypatch):
+    monkeypatch.setattr(skyscraper.settings,
+                        'SKYSCRAPER_STORAGE_FOLDER_PATH', str(tmpdir),
+                        raising=False)
+
+    last_month = datetime.datetime.today().replace(day=1) \
+        - datetime.timedelta(days=15)
+    last_month_time = time.mktime(last_month.timetuple())
+    for spider in ['spider1', 'spider2']:
+        f = tmpdir.join('namespace', spider, 'item.json')
+        f.write('{"foo": "bar"}', ensure=True)
+        os.utime(str(f), (last_month_time, last_month_time))
+
+    runner = CliRunner()
+    result = runner.invoke(skyscraper_archive, ['--jobs', '2'])
+    assert result.exit_code == 0
+
+    archive = last_month.strftime('%Y-%m.jl.gz')
+    for spider in ['spider1', 'spider2']:
+        assert sorted(f.basename for f in
+                      tmpdir.join('namespace', spider).listdir()
+                      if not f.basename.startswith('.')) == \
+            [archive, archive + '.idx']
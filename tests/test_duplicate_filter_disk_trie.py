@@ -1,6 +1,17 @@
+import os
+import time
+import hashlib
 import tempfile
+import multiprocessing
 
+import pytest
+
+from skyscraper.deduplication import BloomFilter
+from skyscraper.deduplication import DEDUPLICATION_CACHE_HITS
 from skyscraper.deduplication import DiskTrieDuplicatesFilter
+from skyscraper.deduplication import ExpiringDuplicatesFilter
+from skyscraper.deduplication import expire_all_generations
+from skyscraper.deduplication import SortedBucket
 
 
 def test_duplicate_detection():
@@ -14,3 +25,339 @@ def test_duplicate_detection():
     assert not f.has_word('baz')
     assert f.has_word('bar')
     assert f.has_word('foo')
+
+
+def test_duplicate_detection_sorted_format():
+    triedir = tempfile.mkdtemp()
+
+    f = DiskTrieDuplicatesFilter(triedir, 'sorted')
+    f.add_word('foo')
+    f.add_word('bar')
+
+    assert not f.has_word('foobar')
+    assert not f.has_word('baz')
+    assert f.has_word('bar')
+    assert f.has_word('foo')
+
+
+def test_sorted_format_finds_words_after_compaction():
+    triedir = tempfile.mkdtemp()
+    words = ['prefix-{}'.format(i) for i in range(2000)]
+
+    f = DiskTrieDuplicatesFilter(triedir, 'sorted')
+    for word in words[:1000]:
+        f.add_word(word)
+    f.compact()
+    for word in words[1000:]:
+        f.add_word(word)
+
+    # a new instance must read the segments and logs from disk
+    f = DiskTrieDuplicatesFilter(triedir, 'sorted')
+    assert all(f.has_word(word) for word in words)
+    assert not f.has_word('prefix-2000')
+    assert not f.has_word('prefix-')
+    assert not f.has_word('')
+    f.close()
+
+
+def test_bloom_filter_is_rebuilt_from_buckets():
+    triedir = tempfile.mkdtemp()
+
+    f = DiskTrieDuplicatesFilter(triedir, 'sorted')
+    f.add_word('foo')
+    f.add_word('bar')
+    f.close()
+
+    # the bloom filter does not exist yet and has to be built from
+    # the words in the buckets
+    f = DiskTrieDuplicatesFilter(triedir, 'sorted', bloom_capacity=1000)
+    assert f.has_word('foo')
+    assert f.has_word('bar')
+    assert not f.has_word('baz')
+
+    f.add_word('baz')
+    f.close()
+
+    f = DiskTrieDuplicatesFilter(triedir, 'sorted', bloom_capacity=1000)
+    assert f.has_word('baz')
+    f.close()
+
+
+def test_bloom_filter_is_rebuilt_after_writes_without_it():
+    triedir = tempfile.mkdtemp()
+
+    f = DiskTrieDuplicatesFilter(triedir, 'sorted', bloom_capacity=1000)
+    f.add_word('foo')
+    f.close()
+
+    # this writer does not know about the bloom filter
+    f = DiskTrieDuplicatesFilter(triedir, 'sorted')
+    f.add_word('bar')
+    f.close()
+
+    f = DiskTrieDuplicatesFilter(triedir, 'sorted', bloom_capacity=1000)
+    assert f.has_word('foo')
+    assert f.has_word('bar')
+    f.close()
+
+
+def test_bloom_filter_is_rebuilt_after_unclean_reboot():
+    triedir = tempfile.mkdtemp()
+
+    f = DiskTrieDuplicatesFilter(triedir, 'sorted', bloom_capacity=1000)
+    f.add_word('foo')
+    f.close()
+
+    # simulate a process that was still running when the OS crashed and
+    # whose bits did not make it to disk
+    bloom = BloomFilter(os.path.join(triedir, 'bloom'))
+    bloom.boot_id = b'previous-boot'
+    bloom.open_count = 1
+    bloom._bits[BloomFilter.HEADER_SIZE:] = \
+        bytes(len(bloom._bits) - BloomFilter.HEADER_SIZE)
+    bloom.close()
+
+    f = DiskTrieDuplicatesFilter(triedir, 'sorted', bloom_capacity=1000)
+    assert f.has_word('foo')
+    f.close()
+
+
+def test_bloom_filter_warns_when_over_capacity(caplog):
+    triedir = tempfile.mkdtemp()
+
+    f = DiskTrieDuplicatesFilter(triedir, 'sorted', bloom_capacity=10)
+    f.add_words(['word-{}'.format(i) for i in range(20)])
+    f.close()
+
+    assert 'capacity' in caplog.text
+
+
+def test_bloom_filter_has_no_false_negatives(tmpdir):
+    path = os.path.join(str(tmpdir), 'bloom')
+    num_bits, num_hashes = BloomFilter.optimal_parameters(1000, 0.01)
+
+    keys = [hashlib.sha256(str(i).encode('utf-8')).digest()
+            for i in range(2000)]
+    bloom = BloomFilter.create(path, num_bits, num_hashes, keys[:1000])
+
+    assert all(bloom.might_contain(key) for key in keys[:1000])
+    false_positives = sum(bloom.might_contain(key) for key in keys[1000:])
+    assert false_positives < 50
+    bloom.close()
+
+
+def test_batch_lookup_and_insert():
+    triedir = tempfile.mkdtemp()
+
+    for bucket_format in ['text', 'sorted']:
+        os.makedirs(os.path.join(triedir, bucket_format))
+        f = DiskTrieDuplicatesFilter(
+            os.path.join(triedir, bucket_format), bucket_format)
+
+        f.add_words(['foo', 'bar', 'baz'])
+        assert f.has_words(['foo', 'baz', 'foobar']) == {'foo', 'baz'}
+        assert f.has_words([]) == set()
+        assert f.has_word('bar')
+        f.close()
+
+
+def test_duplicate_detection_frontcoded_format():
+    triedir = tempfile.mkdtemp()
+    words = ['https://example.com/articles/{}'.format(i) for i in range(500)]
+
+    f = DiskTrieDuplicatesFilter(triedir, 'frontcoded')
+    f.add_words(words)
+    f.compact()
+
+    assert all(f.has_word(word) for word in words)
+    assert not f.has_word('https://example.com/articles/')
+    assert not f.has_word('https://example.com/articles/5000')
+    assert not f.has_word('a')
+    assert not f.has_word('z')
+    f.close()
+
+
+def test_convert_text_buckets():
+    triedir = tempfile.mkdtemp()
+    words = ['https://example.com/articles/{}'.format(i) for i in range(500)]
+
+    f = DiskTrieDuplicatesFilter(triedir, 'text')
+    f.add_words(words)
+
+    f = f.convert_to('frontcoded')
+    assert f.bucket_format == 'frontcoded'
+    assert all(f.has_word(word) for word in words)
+    assert not f.has_word('https://example.com/articles/500')
+    f.close()
+
+    assert not any(len(filename) == 2 for filename in os.listdir(triedir))
+
+
+def test_duplicate_detection_digest_format():
+    triedir = tempfile.mkdtemp()
+    words = ['https://example.com/articles/{}'.format(i) for i in range(500)]
+
+    f = DiskTrieDuplicatesFilter(triedir, 'text')
+    f.add_words(words[:250])
+    f = f.convert_to('digest')
+
+    f.add_words(words[250:])
+    assert all(f.has_word(word) for word in words)
+    assert not f.has_word('https://example.com/articles/500')
+    f.compact()
+    assert f.has_words(words[:10] + ['foo']) == set(words[:10])
+
+    # the original words are not stored
+    with pytest.raises(TypeError):
+        list(f._bucket_by_name('00').words())
+    f.close()
+
+    # the bloom filter can be built from the stored digests
+    f = DiskTrieDuplicatesFilter(triedir, 'digest', bloom_capacity=1000)
+    assert all(f.has_word(word) for word in words)
+    f.close()
+
+
+def _add_words_in_process(triedir, words, queue):
+    f = DiskTrieDuplicatesFilter(
+        triedir, 'sorted', bloom_capacity=1000, locking=True)
+    queue.put(sum(f.add_word_if_new(word) for word in words))
+    f.close()
+
+
+def test_parallel_processes_do_not_insert_duplicates():
+    triedir = tempfile.mkdtemp()
+    words = ['id-{}'.format(i) for i in range(300)]
+
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(
+                    target=_add_words_in_process,
+                    args=(triedir, words, queue))
+                 for _ in range(4)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    # each word must have been new for exactly one of the processes
+    assert sum(queue.get() for _ in processes) == len(words)
+
+    f = DiskTrieDuplicatesFilter(triedir, 'sorted', locking=True)
+    assert all(f.has_word(word) for word in words)
+    f.close()
+
+
+def test_sorted_format_detects_recreated_log():
+    triedir = tempfile.mkdtemp()
+
+    reader = DiskTrieDuplicatesFilter(triedir, 'digest')
+    writer = DiskTrieDuplicatesFilter(triedir, 'digest')
+
+    # four words that end up in the same bucket
+    bucket_name = writer._bucket_name(writer._digest('word-0'))
+    words = [w for w in ('word-{}'.format(i) for i in range(5000))
+             if writer._bucket_name(writer._digest(w)) == bucket_name][:4]
+    bucket = writer._bucket_by_name(bucket_name)
+
+    writer.add_word(words[0])
+    assert reader.has_word(words[0])
+
+    # keep the inode of the old log alive, so that we can put the new
+    # log into it afterwards (like a file system reusing the inode)
+    old_inode_path = bucket.log_path + '.old'
+    os.link(bucket.log_path, old_inode_path)
+
+    writer.compact()
+    writer.add_words(words[1:])
+    with open(bucket.log_path, 'rb') as f:
+        new_log = f.read()
+    with open(old_inode_path, 'r+b') as f:
+        f.write(new_log)
+    os.replace(old_inode_path, bucket.log_path)
+
+    assert all(reader.has_word(word) for word in words)
+
+
+def _add_and_compact_in_process(triedir, words):
+    SortedBucket.MIN_LOG_SIZE = 64
+    f = DiskTrieDuplicatesFilter(triedir, 'sorted')
+    for word in words:
+        f.add_word(word)
+    f.close()
+
+
+def test_compaction_does_not_lose_concurrent_appends():
+    triedir = tempfile.mkdtemp()
+    words = ['id-{}'.format(i) for i in range(2000)]
+
+    processes = [multiprocessing.Process(
+                    target=_add_and_compact_in_process,
+                    args=(triedir, words[i::4]))
+                 for i in range(4)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    f = DiskTrieDuplicatesFilter(triedir, 'sorted')
+    assert all(f.has_word(word) for word in words)
+    f.close()
+
+
+def test_refuses_directory_with_buckets_of_other_format():
+    triedir = tempfile.mkdtemp()
+
+    f = DiskTrieDuplicatesFilter(triedir, 'text')
+    f.add_word('foo')
+    f.close()
+
+    with pytest.raises(ValueError):
+        DiskTrieDuplicatesFilter(triedir, 'frontcoded')
+
+
+def test_cache_answers_repeated_lookups_without_disk():
+    triedir = tempfile.mkdtemp()
+
+    f = DiskTrieDuplicatesFilter(triedir, 'sorted', cache_size=2)
+    f.add_words(['foo', 'bar', 'baz'])
+
+    # remove the buckets, only the cache can answer now
+    for filename in os.listdir(triedir):
+        os.remove(os.path.join(triedir, filename))
+
+    disk_hits = DEDUPLICATION_CACHE_HITS.labels(filter='disk')
+    hits = disk_hits._value.get()
+    assert f.has_word('baz')
+    assert f.has_words(['bar', 'baz']) == {'bar', 'baz'}
+    assert not f.add_word_if_new('bar')
+    assert disk_hits._value.get() == hits + 4
+
+    # the least recently used word has been evicted
+    assert not f.has_word('foo')
+
+
+def test_expiring_filter_forgets_words_after_ttl(tmpdir, monkeypatch):
+    now = 1000000.0
+    monkeypatch.setattr(time, 'time', lambda: now)
+
+    ttl = 8 * 60
+    f = ExpiringDuplicatesFilter(str(tmpdir), ttl, 'sorted')
+    assert f.add_word_if_new('old-word')
+
+    # words are still found in older generations
+    now += ttl / 2
+    assert not f.add_word_if_new('old-word')
+    assert f.add_word_if_new('new-word')
+
+    now += ttl
+    assert not f.has_word('old-word')
+    assert f.has_word('new-word')
+    assert expire_all_generations(str(tmpdir)) == 1
+
+    now += 2 * ttl
+    assert not f.has_word('new-word')
+    assert f.add_word_if_new('old-word')
+    f.close()
+
+    assert expire_all_generations(str(tmpdir)) == 1
+    assert len(os.listdir(str(tmpdir))) == 2
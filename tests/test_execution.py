@@ -1,7 +1,10 @@
 import collections
+import sys
 
 from skyscraper.config import Configuration
+from skyscraper.execution import ScrapySpiderRunner
 from skyscraper.execution import SkyscraperRunner
+from skyscraper.instrumentation import RunHistory
 
 
 class MockSpiderRunner(object):
@@ -29,3 +32,48 @@ def test_skyscraper_runner_runs_due_spiders():
     skyscraper_runner.run_due_spiders()
 
     assert mock_runner.spiders_run['my-project']['my-spider'] is True
+
+
+def test_scrapy_spider_runner_records_run(tmpdir, monkeypatch):
+    # writes stats like a spider subprocess and exits with an error
+    script = '\n'.join([
+        'import json, os, sys',
+        'data = bytearray(20 * 1024 * 1024)',
+        'with open(os.environ["SKYSCRAPER_RUN_STATS_FILE"], "w") as f:',
+        '    json.dump({"item_scraped_count": 3,',
+        '               "downloader/request_count": 5}, f)',
+        'sys.exit(2)',
+    ])
+    monkeypatch.setattr(
+        ScrapySpiderRunner, '_command',
+        lambda self, namespace, spider, options:
+            [sys.executable, '-c', script])
+
+    history = RunHistory(str(tmpdir.join('runs.jl')), max_runs=2)
+    runner = ScrapySpiderRunner(None, history)
+
+    for _ in range(4):
+        run = runner.run_standalone('my-project', 'my-spider')
+
+    assert run['exit_code'] == 2
+    assert run['items'] == 3
+    assert run['requests'] == 5
+    assert run['max_rss'] >= 20 * 1024 * 1024
+    assert run['duration'] > 0
+
+    runs = history.runs()
+    assert 2 <= len(runs) < 4
+    assert runs[-1] == run
+
+
+def test_scrapy_spider_runner_reports_killing_signal(tmpdir, monkeypatch):
+    script = 'import os, signal; os.kill(os.getpid(), signal.SIGKILL)'
+    monkeypatch.setattr(
+        ScrapySpiderRunner, '_command',
+        lambda self, namespace, spider, options:
+            [sys.executable, '-c', script])
+
+    run = ScrapySpiderRunner(None).run_standalone('my-project', 'my-spider')
+
+    assert run['exit_code'] == -9
+    assert run['items'] is None
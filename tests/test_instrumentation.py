@@ -0,0 +1,89 @@
+import os
+
+from scrapy.exceptions import DropItem
+
+from skyscraper.instrumentation import FileCountTracker
+from skyscraper.instrumentation import InstrumentedItemPipelineManager
+from skyscraper.instrumentation import NUMBER_OF_FILES
+from skyscraper.instrumentation import count_files
+from skyscraper.instrumentation import PIPELINE_DROPPED_ITEMS
+from skyscraper.instrumentation import PIPELINE_ITEMS
+
+
+def _num_files(project, spider):
+    return NUMBER_OF_FILES.labels(project=project, spider=spider)._value.get()
+
+
+def test_file_count_tracker_applies_recorded_changes(tmpdir, monkeypatch):
+    folder = tmpdir.join('project', 'spider')
+    folder.join('1.json').write('{}', ensure=True)
+    folder.join('.segment.jl.part').write('{}')
+
+    tracker = FileCountTracker(str(tmpdir))
+    tracker.update()
+    assert _num_files('project', 'spider') == 1
+
+    scans = []
+    original_scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir',
+                        lambda path: scans.append(path) or
+                        original_scandir(path))
+
+    folder.join('2.json').write('{}')
+    folder.join('3.json').write('{}')
+    count_files(str(folder), 2)
+    tracker.update()
+    assert _num_files('project', 'spider') == 3
+
+    folder.join('1.json').remove()
+    count_files(str(folder), -1)
+    tracker.update()
+    assert _num_files('project', 'spider') == 2
+    assert str(folder) not in scans
+
+    # reconciliation lists changed folders again
+    folder.join('4.json').write('{}')
+    tracker.reconcile_interval = 0
+    tracker.update()
+    assert str(folder) in scans
+    assert _num_files('project', 'spider') == 3
+
+
+class _Spider(object):
+    name = 'spider'
+
+
+class _PassPipeline(object):
+    def process_item(self, item, spider):
+        return item
+
+
+class _DropPipeline(object):
+    def process_item(self, item, spider):
+        raise DropItem('duplicate')
+
+
+def _pipeline_metric(metric, pipeline_class):
+    pipeline = '{}.{}'.format(__name__, pipeline_class.__name__)
+    return metric.labels(pipeline=pipeline, namespace='ns',
+                         spider='spider')._value.get()
+
+
+def test_instrumented_item_pipeline_manager_counts_stage_results():
+    manager = InstrumentedItemPipelineManager(_PassPipeline(), _DropPipeline())
+    for stage in manager.methods['process_item']:
+        stage.namespace = 'ns'
+
+    items_before = _pipeline_metric(PIPELINE_ITEMS, _PassPipeline)
+    dropped_before = _pipeline_metric(PIPELINE_DROPPED_ITEMS, _DropPipeline)
+
+    results = []
+    d = manager.process_item({'id': '1'}, _Spider())
+    d.addErrback(lambda failure: results.append(failure.check(DropItem)))
+
+    assert results == [DropItem]
+    assert _pipeline_metric(PIPELINE_ITEMS, _PassPipeline) \
+        == items_before + 1
+    assert _pipeline_metric(PIPELINE_DROPPED_ITEMS, _DropPipeline) \
+        == dropped_before + 1
+    assert _pipeline_metric(PIPELINE_DROPPED_ITEMS, _PassPipeline) == 0
@@ -0,0 +1,91 @@
+import pytest
+
+from scrapy.spiders import Spider
+
+from skyscraper.items import BasicItem
+
+pyarrow = pytest.importorskip('pyarrow')
+import pyarrow.ipc
+import pyarrow.parquet
+
+from skyscraper.blobstore import BlobStore
+from skyscraper.pipelines.blobs import StoreSourceInBlobStorePipeline
+from skyscraper.pipelines.columnar import SaveColumnarDataPipeline
+from skyscraper.storage import FolderStorage
+
+
+def _items():
+    for i in range(3):
+        item = BasicItem()
+        item['id'] = 'id-{}'.format(i)
+        item['url'] = 'http://example.com/{}'.format(i)
+        item['source'] = '<html>{}</html>'.format(i)
+        item['crawl_time'] = '2018-01-01T20:00:0{}'.format(i)
+        item['data'] = {
+            'title': 'Title {}'.format(i),
+            'price': 10 + i,
+            'mixed': 'text' if i else 1,
+        }
+        yield item
+
+
+def test_columnar_pipeline_writes_parquet(tmpdir):
+    pipeline = SaveColumnarDataPipeline(
+        FolderStorage(str(tmpdir)), 'namespace')
+
+    spider = Spider(name='spider')
+    for item in _items():
+        pipeline.process_item(item, spider)
+    pipeline.close_spider(spider)
+
+    files = tmpdir.join('namespace', 'spider').listdir()
+    assert len(files) == 1
+    assert files[0].basename == \
+        '2018-01-01T20:00:00-to-2018-01-01T20:00:02.parquet'
+
+    table = pyarrow.parquet.read_table(
+        str(files[0]), columns=['id', 'data.title', 'data.price', 'data'])
+    assert table.column('data.title').to_pylist() == \
+        ['Title 0', 'Title 1', 'Title 2']
+    assert table.column('data.price').to_pylist() == [10, 11, 12]
+    # keys with changing types are kept as JSON
+    assert table.column('data').to_pylist()[0] == '{"mixed": 1}'
+
+
+def test_columnar_pipeline_writes_arrow(tmpdir):
+    pipeline = SaveColumnarDataPipeline(
+        FolderStorage(str(tmpdir)), 'namespace', file_format='arrow',
+        max_items=2)
+
+    spider = Spider(name='spider')
+    for item in _items():
+        pipeline.process_item(item, spider)
+    pipeline.close_spider(spider)
+
+    files = sorted(tmpdir.join('namespace', 'spider').listdir())
+    assert len(files) == 2
+
+    with pyarrow.ipc.open_file(str(files[0])) as reader:
+        table = reader.read_all()
+    assert table.column('source').to_pylist() == \
+        ['<html>0</html>', '<html>1</html>']
+
+
+def test_columnar_pipeline_keeps_blob_store_references(tmpdir):
+    store = BlobStore(FolderStorage(str(tmpdir.join('blobs'))),
+                      compression='gzip')
+    blob_pipeline = StoreSourceInBlobStorePipeline(store)
+    pipeline = SaveColumnarDataPipeline(
+        FolderStorage(str(tmpdir.join('output'))), 'namespace')
+
+    spider = Spider(name='spider')
+    for item in _items():
+        item = blob_pipeline.process_item(item, spider)
+        pipeline.process_item(item, spider)
+    pipeline.close_spider(spider)
+
+    files = tmpdir.join('output', 'namespace', 'spider').listdir()
+    table = pyarrow.parquet.read_table(str(files[0]))
+    assert table.column('source').to_pylist() == [None, None, None]
+    assert [store.get(ref) for ref in table.column('source_ref').to_pylist()] \
+        == [b'<html>0</html>', b'<html>1</html>', b'<html>2</html>']
@@ -1,20 +1,29 @@
+import os
 import pytest
 import unittest.mock
 import moto
 import boto3
 from boto3.dynamodb.conditions import Key
+import gzip
 import json
+import time
 import datetime
 
 from scrapy.spiders import Spider
 import scrapy.exceptions
+from twisted.internet import reactor
+from twisted.internet.task import Clock
 
+import skyscraper.pipelines.aws
 from skyscraper.pipelines.metainfo import AddCrawlTimePipeline
 from skyscraper.pipelines.mqtt import MqttOutputPipeline
 from skyscraper.pipelines.aws import SaveDataToS3Pipeline
+from skyscraper.pipelines.filesystem import SaveDataToFolderPipeline
+from skyscraper.pipelines.filesystem import SegmentWriter
 from skyscraper.pipelines.aws import DoNotStoreDuplicatesPipeline
 from skyscraper.pipelines.aws import StoreItemToDuplicateFilterPipeline
 from skyscraper.items import BasicItem
+from skyscraper.deduplication import DEDUPLICATION_CACHE_HITS
 
 
 @pytest.fixture
@@ -72,6 +81,11 @@ def dynamodb_table():
     moto.mock_dynamodb2().stop()
 
 
+@pytest.fixture(autouse=True)
+def clear_local_ids():
+    skyscraper.pipelines.aws._local_ids.clear()
+
+
 @pytest.fixture
 def mqtt_client():
     client = unittest.mock.Mock()
@@ -98,6 +112,145 @@ def test_save_data_pipeline_to_s3_does_store(s3_conn):
     assert len(objs) == 1
 
 
+def test_save_data_pipeline_to_s3_uploads_compressed_in_background(
+        s3_conn, monkeypatch):
+    # moto cannot decode bodies with checksum trailers
+    monkeypatch.setenv('AWS_REQUEST_CHECKSUM_CALCULATION', 'when_required')
+    s3 = boto3.Session(
+        aws_access_key_id='dummy',
+        aws_secret_access_key='dummy'
+    ).resource('s3', region_name='us-east-1')
+
+    pipeline = SaveDataToS3Pipeline(
+        s3.Bucket('skyscraper-data'), 'namespace',
+        compression='gzip', upload_workers=2, max_pending_uploads=1)
+
+    spider = Spider(name='spider')
+    for i in range(250):
+        item = BasicItem()
+        item['id'] = 'my-unique-id-{}'.format(i)
+        item['url'] = 'http://example.com/'
+        item['source'] = 'dummy source'
+        item['crawl_time'] = '2018-01-01T20:{:02d}:{:02d}'.format(
+            i // 60, i % 60)
+        pipeline.process_item(item, spider)
+    pipeline.close_spider(spider)
+
+    objs = [obj for obj in s3_conn.Bucket('skyscraper-data').objects.all()]
+    assert len(objs) == 3
+    assert all(obj.key.endswith('.json.gz') for obj in objs)
+
+    lines = []
+    for obj in objs:
+        body = gzip.decompress(obj.get()['Body'].read())
+        lines += body.decode('utf-8').split('\n')
+    assert len(lines) == 250
+
+
+def test_save_data_pipeline_to_s3_flushes_by_bytes_and_age(
+        s3_conn, monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(time, 'monotonic', lambda: now)
+
+    pipeline = SaveDataToS3Pipeline(
+        s3_conn.Bucket('skyscraper-data'), 'namespace',
+        max_bytes=1200, max_age=60)
+
+    spider = Spider(name='spider')
+    for i in range(3):
+        item = BasicItem()
+        item['id'] = 'my-unique-id-{}'.format(i)
+        item['url'] = 'http://example.com/'
+        item['source'] = 'x' * 400
+        item['crawl_time'] = '2018-01-01T20:00:{:02d}'.format(i)
+        pipeline.process_item(item, spider)
+
+    # the third item exceeded the byte limit
+    assert pipeline.buffered_bytes['spider'] == 0
+    assert len(list(s3_conn.Bucket('skyscraper-data').objects.all())) == 1
+
+    item['crawl_time'] = '2018-01-01T20:00:10'
+    pipeline.process_item(item, spider)
+    assert pipeline.buffered_bytes['spider'] > 400
+
+    now += 61
+    item['crawl_time'] = '2018-01-01T20:01:11'
+    pipeline.process_item(item, spider)
+    assert len(list(s3_conn.Bucket('skyscraper-data').objects.all())) == 2
+
+
+def test_save_data_pipeline_to_folder_writes_segments(tmpdir):
+    pipeline = SaveDataToFolderPipeline(
+        str(tmpdir), 'namespace', segments=True, segment_max_bytes=1000)
+
+    spider = Spider(name='spider')
+    for i in range(10):
+        item = BasicItem()
+        item['id'] = 'my-unique-id-{}'.format(i)
+        item['url'] = 'http://example.com/'
+        item['source'] = 'x' * 200
+        pipeline.process_item(item, spider)
+
+    folder = tmpdir.join('namespace', 'spider')
+    # only complete segments are visible
+    assert len([f for f in folder.listdir()
+                if not f.basename.startswith('.')]) == 2
+
+    pipeline.close_spider(spider)
+
+    segments = folder.listdir(lambda f: not f.basename.startswith('.'))
+    assert len(segments) == 3
+    assert all(f.basename.endswith('.jl') for f in segments)
+
+    lines = []
+    for segment in segments:
+        lines += segment.read().splitlines()
+    assert sorted(json.loads(line)['id'] for line in lines) == \
+        sorted('my-unique-id-{}'.format(i) for i in range(10))
+
+
+@pytest.mark.parametrize('segments', [False, True])
+def test_save_data_pipeline_to_folder_writes_in_background(
+        tmpdir, monkeypatch, segments):
+    fsyncs = []
+    monkeypatch.setattr(os, 'fsync', fsyncs.append)
+
+    pipeline = SaveDataToFolderPipeline(
+        str(tmpdir), 'namespace', segments=segments, background=True,
+        queue_size=2, sync=True)
+
+    spider = Spider(name='spider')
+    for i in range(10):
+        item = BasicItem()
+        item['id'] = 'my-unique-id-{}'.format(i)
+        item['url'] = 'http://example.com/'
+        pipeline.process_item(item, spider)
+
+    # close_spider waits until all items are written
+    pipeline.close_spider(spider)
+
+    lines = []
+    for f in tmpdir.join('namespace', 'spider').listdir('*.j*'):
+        lines += f.read().splitlines()
+    assert len(lines) == 10
+
+    # only segments are synced, at most once per batch
+    if segments:
+        assert 1 <= len(fsyncs) <= 10
+    else:
+        assert fsyncs == []
+
+
+def test_segment_writer_completes_segments_of_dead_processes(tmpdir):
+    orphan = tmpdir.join('.999999999-20180101T200000-abc.jl.part')
+    orphan.write('{"id": "1"}\n')
+
+    SegmentWriter(str(tmpdir))
+
+    assert [f.basename for f in tmpdir.listdir('*.jl')] == \
+        ['20180101T200000-abc.jl']
+
+
 def test_save_store_dup_pipeline_does_keep_duplicates_log(dynamodb_table):
     pipeline = StoreItemToDuplicateFilterPipeline(
         dynamodb_table,
@@ -120,6 +273,79 @@ def test_save_store_dup_pipeline_does_keep_duplicates_log(dynamodb_table):
     assert response['Count'] == 1
 
 
+def test_store_dup_pipeline_buffers_writes(dynamodb_table):
+    pipeline = StoreItemToDuplicateFilterPipeline(
+        dynamodb_table, 'namespace', buffer_size=30)
+
+    spider = Spider(name='spider')
+    for i in range(40):
+        item = BasicItem()
+        item['id'] = 'id-{}'.format(i % 35)
+        item['url'] = 'http://example.com/'
+        item['crawl_time'] = '2018-01-01T20:00:00Z'
+        pipeline.process_item(item, spider)
+
+    # the first 30 items were written in two requests
+    assert dynamodb_table.scan()['Count'] == 30
+
+    pipeline.close_spider(spider)
+    assert dynamodb_table.scan()['Count'] == 35
+
+
+def test_store_dup_pipeline_flushes_idle_buffer_by_timer(
+        dynamodb_table, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(reactor, 'callLater', clock.callLater)
+
+    pipeline = StoreItemToDuplicateFilterPipeline(
+        dynamodb_table, 'namespace', buffer_size=30, buffer_seconds=5.0)
+
+    item = BasicItem()
+    item['id'] = 'my-unique-id'
+    item['url'] = 'http://example.com/'
+    item['crawl_time'] = '2018-01-01T20:00:00Z'
+    pipeline.process_item(item, Spider(name='spider'))
+    assert dynamodb_table.scan()['Count'] == 0
+
+    clock.advance(5)
+    assert dynamodb_table.scan()['Count'] == 1
+
+
+@pytest.mark.parametrize('batch_size', [1, 3])
+def test_duplicate_pipelines_drop_buffered_ids(dynamodb_table, batch_size):
+    check = DoNotStoreDuplicatesPipeline(
+        dynamodb_table, 'my-namespace', batch_size=batch_size,
+        batch_window=None)
+    store = StoreItemToDuplicateFilterPipeline(
+        dynamodb_table, 'my-namespace', buffer_size=10, flush_timer=False)
+
+    spider = Spider(name='spider')
+    passed = []
+    for _ in range(3):
+        item = {
+            'id': 'myspider-myuniqueid',
+            'url': 'https://localhost/',
+            'crawl_time': '2018-01-01T20:00:00',
+        }
+        try:
+            result = check.process_item(item, spider)
+        except scrapy.exceptions.DropItem:
+            continue
+
+        if batch_size == 1:
+            passed.append(store.process_item(result, spider))
+        else:
+            # each item is checked in a batch of its own
+            result.addCallbacks(
+                lambda item: passed.append(store.process_item(item, spider)),
+                lambda failure: failure.trap(scrapy.exceptions.DropItem))
+            check.flush()
+
+    assert len(passed) == 1
+    # nothing has been written to the index yet
+    assert dynamodb_table.scan()['Count'] == 0
+
+
 def test_duplicate_detection_pipeline(dynamodb_table):
     spider = Spider(name='spider')
 
@@ -149,6 +375,56 @@ def test_duplicate_detection_pipeline(dynamodb_table):
     pipeline.process_item(new_item, spider)
 
 
+def test_duplicate_detection_pipeline_batched(dynamodb_table):
+    spider = Spider(name='spider')
+    dynamodb_table.put_item(Item={
+        'Namespace': 'my-namespace',
+        'Id': 'myspider-known',
+        'CrawlTime': '2018-01-01T20:00:00',
+        'Url': 'https://localhost/',
+        'Spider': spider.name
+    })
+
+    pipeline = DoNotStoreDuplicatesPipeline(
+        dynamodb_table, 'my-namespace', batch_size=3, cache_size=10)
+
+    results = []
+    for id_ in ['myspider-known', 'myspider-new', 'myspider-new']:
+        item = {'id': id_, 'url': 'https://localhost/'}
+        d = pipeline.process_item(item, spider)
+        d.addCallbacks(lambda item: results.append(item['id']),
+                       lambda failure: results.append(failure.type))
+
+    assert results == [
+        scrapy.exceptions.DropItem, 'myspider-new', scrapy.exceptions.DropItem]
+
+    # confirmed duplicates are answered from the cache
+    hits = DEDUPLICATION_CACHE_HITS.labels(filter='dynamodb')._value.get()
+    with unittest.mock.patch.object(dynamodb_table, 'query') as query:
+        with pytest.raises(scrapy.exceptions.DropItem):
+            pipeline.process_item(
+                {'id': 'myspider-known', 'url': 'https://localhost/'}, spider)
+        assert not query.called
+    assert DEDUPLICATION_CACHE_HITS.labels(filter='dynamodb')._value.get() \
+        == hits + 1
+
+
+def test_duplicate_detection_pipeline_retries_unprocessed_keys():
+    index = unittest.mock.Mock()
+    index.name = 'CrawlingLog'
+    key = {'Namespace': 'my-namespace', 'Id': 'myspider-known'}
+    index.meta.client.batch_get_item.side_effect = [
+        {'Responses': {},
+         'UnprocessedKeys': {'CrawlingLog': {'Keys': [key]}}},
+        {'Responses': {'CrawlingLog': [{'Id': 'myspider-known'}]}},
+    ]
+
+    pipeline = DoNotStoreDuplicatesPipeline(
+        index, 'my-namespace', batch_size=2)
+    assert pipeline._batch_get_ids({'myspider-known'}) == {'myspider-known'}
+    assert index.meta.client.batch_get_item.call_count == 2
+
+
 def test_mqtt_pipeline_does_send_item(mqtt_client):
     spider = Spider(name='spider')
     pipeline = MqttOutputPipeline(mqtt_client, 'dummy-namespace')
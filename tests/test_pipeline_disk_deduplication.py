@@ -1,13 +1,17 @@
 import pytest
 import json
+import unittest.mock
 import datetime
 
 from scrapy.spiders import Spider
+from scrapy.settings import Settings
 import scrapy.exceptions
 from skyscraper.items import BasicItem
 from scrapy.exceptions import DropItem
 
 from skyscraper.pipelines.filesystem import DiskDeduplicationPipeline
+from skyscraper.pipelines.filesystem import deduplication_ttl_days
+from skyscraper.deduplication import ExpiringDuplicatesFilter
 
 
 class MockDeduplication():
@@ -20,6 +24,17 @@ class MockDeduplication():
     def has_word(self, word):
         return word in self.s
 
+    def add_word_if_new(self, word):
+        return word in self.add_words_if_new([word])
+
+    def add_words_if_new(self, words):
+        new_words = set(words) - self.s
+        self.s.update(new_words)
+        return new_words
+
+    def close(self):
+        pass
+
 
 def test_filters_duplicate_item():
     pipeline = DiskDeduplicationPipeline(MockDeduplication(), 'namespace')
@@ -43,3 +58,99 @@ def test_filters_duplicate_item():
     item['url'] = 'http://example.com/'
     item['source'] = 'dummy source'
     pipeline.process_item(item, spider)
+
+
+def test_buffered_mode_filters_duplicates_in_batches():
+    duplicates_filter = MockDeduplication()
+    duplicates_filter.add_word('namespace-seen-before')
+    pipeline = DiskDeduplicationPipeline(
+        duplicates_filter, 'namespace', batch_size=3, batch_window=None)
+
+    spider = Spider(name='spider')
+    results = []
+    for item_id in ['seen-before', 'new-id', 'new-id', 'other-id']:
+        item = BasicItem()
+        item['id'] = item_id
+        item['url'] = 'http://example.com/'
+
+        d = pipeline.process_item(item, spider)
+        d.addCallbacks(lambda item: results.append(item['id']),
+                       lambda failure: results.append(failure.type))
+
+    # the first three items are checked as soon as the batch is full
+    assert results == [DropItem, 'new-id', DropItem]
+
+    pipeline.close_spider(spider)
+    assert results == [DropItem, 'new-id', DropItem, 'other-id']
+    assert duplicates_filter.has_word('namespace-other-id')
+
+
+class FailingDeduplication(MockDeduplication):
+    def add_words_if_new(self, words):
+        raise IOError('disk failure')
+
+
+def test_buffered_mode_fails_pending_items_on_filter_error():
+    pipeline = DiskDeduplicationPipeline(
+        FailingDeduplication(), 'namespace', batch_size=2, batch_window=None)
+
+    spider = Spider(name='spider')
+    errors = []
+    for item_id in ['first-id', 'second-id']:
+        item = BasicItem()
+        item['id'] = item_id
+        item['url'] = 'http://example.com/'
+
+        d = pipeline.process_item(item, spider)
+        d.addErrback(lambda failure: errors.append(failure.type))
+
+    assert errors == [IOError, IOError]
+
+
+def test_buffered_mode_is_disabled_for_other_engines(tmpdir):
+    settings = Settings({
+        'USER_NAMESPACE': 'namespace',
+        'DISK_DEDUPLICATION_FOLDER': str(tmpdir),
+        'DISK_DEDUPLICATION_BATCH_SIZE': 100,
+    })
+    crawler = unittest.mock.Mock(settings=settings)
+
+    pipeline = DiskDeduplicationPipeline.from_crawler(crawler)
+    assert pipeline.batch_size == 1
+
+    spider = Spider(name='spider')
+    pipeline.open_spider(spider)
+
+    item = BasicItem()
+    item['id'] = 'my-unique-id'
+    item['url'] = 'http://example.com/'
+    assert pipeline.process_item(item, spider) is item
+    pipeline.close_spider(spider)
+
+
+def test_ttl_of_spider_uses_expiring_filter(tmpdir):
+    settings = Settings({
+        'USER_NAMESPACE': 'namespace',
+        'DISK_DEDUPLICATION_FOLDER': str(tmpdir),
+        'DISK_DEDUPLICATION_TTL_DAYS': '30,namespace/spider=7',
+    })
+    crawler = unittest.mock.Mock(settings=settings)
+
+    pipeline = DiskDeduplicationPipeline.from_crawler(crawler)
+    pipeline.open_spider(Spider(name='spider'))
+
+    assert isinstance(pipeline.duplicates_filter, ExpiringDuplicatesFilter)
+    assert pipeline.duplicates_filter.ttl == 7 * 24 * 60 * 60
+    assert tmpdir.join('expiring', 'namespace', 'spider').isdir()
+    pipeline.close_spider(Spider(name='spider'))
+
+
+def test_deduplication_ttl_days():
+    config = '30,news=7,news/ticker=1,blog=0'
+
+    assert deduplication_ttl_days(config, 'news', 'ticker') == 1
+    assert deduplication_ttl_days(config, 'news', 'other') == 7
+    assert deduplication_ttl_days(config, 'other', 'spider') == 30
+    assert deduplication_ttl_days(config, 'blog', 'spider') is None
+    assert deduplication_ttl_days('news=7', 'other', 'spider') is None
+    assert deduplication_ttl_days(None, 'news', 'ticker') is None
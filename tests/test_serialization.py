@@ -0,0 +1,35 @@
+import json
+
+import pytest
+
+from skyscraper.items import BasicItem
+import skyscraper.serialization
+
+
+def test_items_are_serialized_once():
+    item = BasicItem()
+    item['id'] = 'my-unique-id'
+    item['data'] = {'title': 'Title'}
+
+    data = skyscraper.serialization.serialize(item)
+    assert json.loads(data) == {'id': 'my-unique-id',
+                                'data': {'title': 'Title'}}
+    assert skyscraper.serialization.serialize(item) is data
+
+    item['url'] = 'http://example.com/'
+    skyscraper.serialization.forget(item)
+    assert json.loads(skyscraper.serialization.serialize(item))['url'] == \
+        'http://example.com/'
+
+
+def test_orjson_codec():
+    pytest.importorskip('orjson')
+
+    item = {'id': 'my-unique-id', 'source': '<html>ä</html>'}
+    data = skyscraper.serialization.serialize(item, 'orjson')
+    assert json.loads(data) == item
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        skyscraper.serialization.serialize({'id': '1'}, 'xml')